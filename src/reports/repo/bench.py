@@ -0,0 +1,169 @@
+"""Benchmark of loading the rpmmd packages of a primary.xml
+
+Times parsing a primary.xml file alone and loading its packages, with and
+without Repo.header_only, then indexing their provides as diffing does. On
+a given file or on a generated one when no file is given:
+
+    python -m reports.repo.bench [--packages N] [--rounds N] [primary.xml]
+
+As with timeit, the garbage collector is disabled while timing and the best
+round is kept. The rounds of the loads are interleaved so that a slower
+machine does not favor one of them.
+"""
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+from . import rpmmd
+
+_PACKAGE = """<package type="rpm">
+  <name>%(name)s</name>
+  <arch>armv7hl</arch>
+  <version epoch="0" ver="1.%(num)d" rel="1"/>
+  <checksum type="sha256" pkgid="YES">%(num)064x</checksum>
+  <summary>Summary of %(name)s</summary>
+  <description>%(description)s</description>
+  <packager>nobody</packager>
+  <url>http://example.com/%(name)s</url>
+  <time file="1" build="1"/>
+  <size package="1" installed="1" archive="1"/>
+  <location href="armv7hl/%(name)s-1.%(num)d-1.armv7hl.rpm"/>
+  <format>
+    <rpm:license>GPLv2</rpm:license>
+    <rpm:vendor>vendor</rpm:vendor>
+    <rpm:group>System</rpm:group>
+    <rpm:buildhost>builder</rpm:buildhost>
+    <rpm:sourcerpm>%(name)s-1.%(num)d-1.src.rpm</rpm:sourcerpm>
+    <rpm:header-range start="1" end="2"/>
+    <rpm:provides>
+%(provides)s
+    </rpm:provides>
+    <rpm:requires>
+%(requires)s
+    </rpm:requires>
+    <file>/usr/bin/%(name)s</file>
+  </format>
+</package>
+"""
+
+
+def generate_primary(filename, packages):
+    """Write a primary.xml with `packages` synthetic packages"""
+    with open(filename, "w") as fd:
+        fd.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata xmlns="%s" xmlns:rpm="%s" packages="%d">\n' %
+            (rpmmd.NS_COMMON, rpmmd.NS_RPM, packages)
+        )
+        for num in xrange(packages):
+            name = "package%d" % num
+            fd.write(_PACKAGE % {
+                "name": name,
+                "num": num,
+                "description": escape("Description of <%s>\n" % name) * 5,
+                "provides": "\n".join(
+                    '<rpm:entry name="lib%s.so.%d"/>' % (name, i)
+                    for i in range(5)
+                ),
+                "requires": "\n".join(
+                    '<rpm:entry name="package%d" flags="GE" epoch="0" '
+                    'ver="1.0"/>' % ((num + i) % packages)
+                    for i in range(10)
+                ),
+            })
+        fd.write("</metadata>\n")
+
+
+def _parse(filename, cachedir):
+    return sum(1 for _ in rpmmd.stream_iter(
+        filename, rpmmd.MD_TAGS["primary"]))
+
+
+def _loader(header_only, index=False):
+    def load(filename, cachedir):
+        repo = rpmmd.Repo("bench", "http://localhost/", cachedir=cachedir)
+        repo._mds = {"primary": filename}
+        repo.header_only = header_only
+        count = len(repo.packages)
+        if index:
+            repo.capabilities("provides")
+        return count
+    return load
+
+
+LOADS = [
+    ("parsing", _parse),
+    ("packages", _loader(False)),
+    ("header only", _loader(True)),
+    ("packages + provides", _loader(False, index=True)),
+    ("header only + provides", _loader(True, index=True)),
+]
+
+
+def _time(load, filename, cachedir):
+    rpmmd.InternPool().clear()
+    rpmmd.PackageStore().clear()
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.time()
+        count = load(filename, cachedir)
+        return time.time() - start, count
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def run(filename, rounds=5):
+    """Time each of LOADS on filename, return best times in seconds"""
+    results = {}
+    cachedir = tempfile.mkdtemp()
+    try:
+        for _ in range(rounds):
+            for name, load in LOADS:
+                elapsed, count = _time(load, filename, cachedir)
+                if name not in results or elapsed < results[name][0]:
+                    results[name] = (elapsed, count)
+    finally:
+        shutil.rmtree(cachedir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("primary", nargs="?", help="primary.xml to parse")
+    parser.add_argument("--packages", type=int, default=20000,
+                        help="number of packages to generate")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    filename = args.primary
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix="-primary.xml")
+        os.close(fd)
+        generate_primary(filename, args.packages)
+
+    try:
+        print "%s, %d bytes" % (filename, os.path.getsize(filename))
+        results = run(filename, rounds=args.rounds)
+        for name, load in LOADS:
+            elapsed, count = results[name]
+            print "%-23s %8.3fs %d packages" % (name, elapsed, count)
+        stats = rpmmd.InternPool().stats
+        print "%-23s %8d strings %d evrs %d capabilities" % (
+            "interned", stats["strings"], stats["evrs"],
+            stats["capabilities"])
+        print "%-23s %8.1fMB in %d hits" % (
+            "saved", stats["saved"] / 1024.0 / 1024, stats["hits"])
+    finally:
+        if args.primary is None:
+            os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main()
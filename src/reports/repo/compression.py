@@ -0,0 +1,191 @@
+"""Streaming decompression of repository metadata files
+
+createrepo can compress metadata with gzip, bzip2, xz or zstd. The format
+is detected from the magic bytes at the start of the data, falling back to
+the suffix of the location href.
+"""
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = [
+    ("gz", "\x1f\x8b"),
+    ("bz2", "BZh"),
+    ("xz", "\xfd7zXZ\x00"),
+    ("zst", "\x28\xb5\x2f\xfd"),
+]
+
+SUFFIXES = {
+    ".gz": "gz",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".zst": "zst",
+    ".zstd": "zst",
+}
+
+
+class UnsupportedCompression(ValueError):
+    pass
+
+
+def detect(href, head=""):
+    """Return compression of a file from its first bytes and location
+
+    Returns one of "gz", "bz2", "xz", "zst" or None for uncompressed data.
+
+    >>> detect("repodata/abc-primary.xml.gz")
+    'gz'
+    >>> detect("repodata/abc-primary.xml", "\\x28\\xb5\\x2f\\xfd\\x00")
+    'zst'
+    >>> detect("repodata/abc-primary.xml.gz", "<?xml")
+    'gz'
+    >>> detect("repodata/abc-primary.xml", "<?xml") is None
+    True
+    """
+    for kind, magic in MAGIC:
+        if head.startswith(magic):
+            return kind
+    for suffix, kind in SUFFIXES.iteritems():
+        if href.endswith(suffix):
+            return kind
+    return None
+
+
+def _gzip_decompressobj():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class _MultiStreamDecompressor(object):
+    """Decompression of all the streams of the data, as gzip.GzipFile
+
+    pigz, pbzip2 and appending to a compressed file write several streams
+    (gzip members) one after the other, with possibly zero padding after
+    them. factory returns the decompressor of a single stream.
+
+    >>> def gzip(text):
+    ...     obj = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    ...     return obj.compress(text) + obj.flush()
+    >>> def decompress(factory, data):
+    ...     # in chunks of each size, to end streams at any point of a chunk
+    ...     results = set()
+    ...     for size in range(1, len(data) + 1):
+    ...         dec = _MultiStreamDecompressor(factory)
+    ...         out = "".join(dec.decompress(data[i:i + size])
+    ...                       for i in range(0, len(data), size))
+    ...         results.add(out + dec.flush())
+    ...     return sorted(results)
+    >>> decompress(_gzip_decompressobj,
+    ...            gzip("hello ") + gzip("world") + "\\0" * 4)
+    ['hello world']
+    >>> decompress(bz2.BZ2Decompressor,
+    ...            bz2.compress("hello ") + bz2.compress("world"))
+    ['hello world']
+
+    xz streams are padded to multiples of 4 bytes
+
+    >>> if lzma is not None:
+    ...     assert decompress(lzma.LZMADecompressor, (
+    ...         lzma.compress("hello ") + "\\0" * 4 + lzma.compress("world")
+    ...     )) == ["hello world"]
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = factory()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            if self._obj is None:
+                # between streams, skip the padding as gzip.GzipFile does
+                data = data.lstrip("\0")
+                if not data:
+                    break
+                self._obj = self._factory()
+            try:
+                out.append(self._obj.decompress(data))
+            except EOFError:
+                # bz2 and lzma refuse data after the end of the stream
+                # instead of keeping it in unused_data
+                self._obj = None
+                continue
+            # data following the end of the stream
+            data = self._obj.unused_data
+            if data:
+                self._obj = None
+        return "".join(out)
+
+    def flush(self):
+        flush = getattr(self._obj, "flush", None)
+        if flush is None:
+            return ""
+        return flush()
+
+
+class StreamDecompressor(object):
+    """Decompress data incrementally, chunk by chunk
+
+    >>> dec = StreamDecompressor(None)
+    >>> dec.decompress("foo") + dec.flush()
+    'foo'
+    >>> gzip = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    >>> data = gzip.compress("foo" * 100) + gzip.flush()
+    >>> dec = StreamDecompressor("gz")
+    >>> out = "".join(dec.decompress(data[i:i + 7])
+    ...               for i in range(0, len(data), 7))
+    >>> out + dec.flush() == "foo" * 100
+    True
+    >>> dec = StreamDecompressor("bz2")
+    >>> dec.decompress(bz2.compress("bar")) + dec.flush()
+    'bar'
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self._flush = None
+        if kind is None:
+            self._decompress = lambda data: data
+        elif kind == "gz":
+            self._multi_stream(_gzip_decompressobj)
+        elif kind == "bz2":
+            self._multi_stream(bz2.BZ2Decompressor)
+        elif kind == "xz":
+            if lzma is None:
+                raise UnsupportedCompression(
+                    "xz compressed metadata requires the lzma module")
+            self._multi_stream(lzma.LZMADecompressor)
+        elif kind == "zst":
+            if zstandard is None:
+                raise UnsupportedCompression(
+                    "zstd compressed metadata requires the zstandard module")
+            self._decompress = \
+                zstandard.ZstdDecompressor().decompressobj().decompress
+        else:
+            raise UnsupportedCompression(
+                "Unknown compression '%s'" % kind)
+
+    def _multi_stream(self, factory):
+        obj = _MultiStreamDecompressor(factory)
+        self._decompress = obj.decompress
+        self._flush = obj.flush
+
+    def decompress(self, data):
+        return self._decompress(data)
+
+    def flush(self):
+        if self._flush is None:
+            return ""
+        return self._flush()
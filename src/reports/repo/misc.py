@@ -1,13 +1,13 @@
 import datetime
 from collections import defaultdict, OrderedDict
-from operator import attrgetter
 import os
 import glob
 import pwd
 import stat
 import tempfile
 
-from .rpmutils import evrcmp
+from .rpmmd import FLAG_NAMES
+from .rpmutils import evr_key
 
 
 # TODO drop this on python3 port
@@ -80,8 +80,7 @@ def _find_repo_by_id(repo, repoid):
 
 def _fmt_chlog(chlog):
     chlog.sort(
-        cmp=evrcmp,
-        key=attrgetter('version'),
+        key=lambda item: evr_key(item.version),
         reverse=True,
     )
     flat = []
@@ -283,6 +282,21 @@ def _search(querytype, query, container, exact=True, casei=False):
     return _regroup(pos, container)
 
 
+def _abi_capability(cap):
+    """Capability as exported in the ABI listing, with the flag name
+
+    >>> import json
+    >>> from .rpmmd import Capability
+    >>> from .rpmutils import EVR
+    >>> json.dumps([
+    ...     _abi_capability(Capability("libfoo.so", 8, EVR("0", "1.0", "1"))),
+    ...     _abi_capability(Capability("bar", None, EVR(None, None, None))),
+    ... ])
+    '[["libfoo.so", "EQ", [0, "1.0", "1"]], ["bar", null, [0, "", ""]]]'
+    """
+    return (cap.name, FLAG_NAMES.get(cap.flag), cap.EVR)
+
+
 def _gen_abi(abi_obj):
 
     yumsack = abi_obj.version.target.yumsack
@@ -291,12 +305,13 @@ def _gen_abi(abi_obj):
         names = [name.strip() for name in abi_obj.public.splitlines()]
         pos = yumsack.search_name(names)
         for name, po in pos:
-            abi["public"].update(po.provides)
+            abi["public"].update(_abi_capability(cap) for cap in po.provides)
     if abi_obj.private.strip():
         names = [name.strip() for name in abi_obj.private.splitlines()]
         pos = yumsack.search_name(names)
         for name, po in pos:
-            abi["private"].update(po.provides)
+            abi["private"].update(
+                _abi_capability(cap) for cap in po.provides)
     if abi_obj.files.strip():
         abi["files"] = [name.strip() for name in abi_obj.files.splitlines()]
 
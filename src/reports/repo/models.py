@@ -3,8 +3,7 @@ import os
 import urlparse
 from collections import defaultdict
 from copy import copy
-
-import requests
+from itertools import chain
 
 from django.conf import settings
 from django.contrib.auth.backends import RemoteUserBackend
@@ -27,6 +26,20 @@ except ImportError:
     # during development it is in the cwd
     from jsonfield import JSONField
 
+rpmmd.RepoRegistry().max_size = settings.YUM_REGISTRY_SIZE
+rpmmd.Session().configure(
+    timeout=(settings.YUM_CONNECT_TIMEOUT, settings.YUM_READ_TIMEOUT),
+    retries=settings.YUM_RETRIES,
+    pool_size=settings.YUM_POOL_SIZE,
+)
+rpmmd.CircuitBreaker().configure(
+    failures=settings.YUM_BREAKER_FAILURES,
+    cooldown=settings.YUM_BREAKER_COOLDOWN,
+)
+rpmmd.Repo.store = settings.YUM_STORE
+rpmmd.Repo.upstream_db = settings.YUM_UPSTREAM_DB
+rpmmd.Repo.header_only = settings.YUM_HEADER_ONLY
+
 
 class Arch(models.Model):
 
@@ -152,6 +165,12 @@ class Repo(models.Model):
     def yumrepoid(self):
         return str(self.pk)
 
+    @property
+    def yumrepottl(self):
+        if self.is_live:
+            return settings.YUM_LIVE_TTL
+        return settings.YUM_RELEASED_TTL
+
     @property
     def packages(self):
         cachekey = "%s%s" % ("repopackages", self.id)
@@ -257,43 +276,66 @@ class Repo(models.Model):
         if hasattr(self, "_yumrepos"):
             return self._yumrepos
 
-        comp = None
-        self._yumrepos = []
-        for comp in self.comps:
-            self._yumrepos.extend(comp.yumrepos)
-
-        if comp is None:
-            archs = [arch.name for arch in self.archs.all()]
-            # backward compat, as well as passthrough for urls without @ARCH@
-            if not archs:
-                archs = ["armv7hl"]
+        # fetch the repos of all components at once, so that the time
+        # it takes is set by the slowest one instead of the sum of all
+        comps = [self]
+        if self.comps:
+            comps = [
+                comp for comp in self.comps if not hasattr(comp, "_yumrepos")
+            ]
+        specs = [comp._yumrepo_specs() for comp in comps]
+        yumrepos = rpmmd.RepoRegistry().get_many(
+            list(chain.from_iterable(specs)),
+            workers=settings.YUM_FETCH_WORKERS,
+        )
+        for comp, comp_specs in zip(comps, specs):
+            comp._yumrepos = [
+                yumrepo for yumrepo in yumrepos[:len(comp_specs)] if yumrepo
+            ]
+            yumrepos = yumrepos[len(comp_specs):]
 
-            # replace @ARCH@ to desired arch
-            for arch in archs:
-                yumrepoid = self.yumrepoid
-                yumrepourl = self.yumrepourl.replace("@ARCH@", arch)
-                print yumrepourl
-                cachedir = os.path.join(
-                    _get_cache_dir(tmpdir=settings.YUM_CACHE_DIR),
-                    self.yumrepoid, str(arch),
-                )
-                try:
-                    yumrepo = rpmmd.Repo(
-                        yumrepoid, yumrepourl, cachedir=cachedir,
-                        ssl_verify=settings.SSL_VERIFY,
-                    )
-                    self._yumrepos.append(yumrepo)
-                except requests.exceptions.RequestException, exc:
-                    print exc
+        if self.comps:
+            self._yumrepos = []
+            for comp in self.comps:
+                self._yumrepos.extend(comp.yumrepos)
 
         return self._yumrepos
 
+    def _yumrepo_specs(self):
+        archs = [arch.name for arch in self.archs.all()]
+        # backward compat, as well as passthrough for urls without @ARCH@
+        if not archs:
+            archs = ["armv7hl"]
+
+        # replace @ARCH@ to desired arch
+        specs = []
+        for arch in archs:
+            yumrepourl = self.yumrepourl.replace("@ARCH@", arch)
+            print yumrepourl
+            cachedir = os.path.join(
+                _get_cache_dir(tmpdir=settings.YUM_CACHE_DIR),
+                self.yumrepoid, str(arch),
+            )
+            specs.append({
+                "repoid": self.yumrepoid,
+                "baseurl": yumrepourl,
+                "cachedir": cachedir,
+                "ssl_verify": settings.SSL_VERIFY,
+                "ttl": self.yumrepottl,
+            })
+        return specs
+
     @property
     def yumsack(self):
         if hasattr(self, '_yumsack'):
             return self._yumsack
 
-        self._yumsack = rpmmd.RepoSack(self.yumrepos)
+        # parse the primary metadata of all the repos in parallel
+        yumrepos = rpmmd.RepoRegistry().ensure_loaded(
+            self.yumrepos, kinds=("primary",),
+            workers=settings.YUM_FETCH_WORKERS,
+        )
+        self._yumsack = rpmmd.RepoSack(yumrepos)
         return self._yumsack
 
     @property
@@ -0,0 +1,119 @@
+"""Memory mapped index of the file paths of a repository
+
+The index is a file of sorted "path\\0pkgid\\n" lines, looked up by binary
+search on a read only mmap, so it costs no memory beyond the pages the OS
+caches and can be shared by processes serving the same repo revision.
+
+>>> import tempfile
+>>> fd, filename = tempfile.mkstemp()
+>>> PathIndex.build(filename, [
+...     ("/usr/bin/foo", "a1"), ("/usr/share/foo/README", "a1"),
+...     ("/usr/bin/bar", "b2"), ("/usr/bin/foo", "c3"),
+...     ("/usr/share/foobar", "b2"),
+... ])
+>>> index = PathIndex(filename)
+>>> len(index)
+5
+>>> index.lookup("/usr/bin/foo")
+['a1', 'c3']
+>>> index.lookup("/usr/bin")
+[]
+>>> list(index.prefix("/usr/share/foo"))
+[('/usr/share/foo/README', 'a1')]
+>>> list(index.prefix("/usr/bin/"))[:2]
+[('/usr/bin/bar', 'b2'), ('/usr/bin/foo', 'a1')]
+>>> index.close()
+>>> os.unlink(filename)
+"""
+import mmap
+import os
+import tempfile
+
+
+def _encode(path):
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    return path
+
+
+class PathIndex(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mmap = None
+        self._size = os.path.getsize(filename)
+        if self._size:
+            with open(filename, "rb") as fd:
+                self._mmap = mmap.mmap(
+                    fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def build(filename, entries):
+        """Write the index of an iterable of (path, pkgid) to filename"""
+        lines = sorted(
+            "%s\0%s\n" % (_encode(path), pkgid)
+            for path, pkgid in entries
+            # such paths would break the line format, rpm does not allow them
+            if "\n" not in path and "\0" not in path
+        )
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, "wb") as tmpfd:
+                tmpfd.writelines(lines)
+            os.rename(tmpname, filename)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+    def __len__(self):
+        if self._mmap is None:
+            return 0
+        count = 0
+        pos = self._mmap.find("\n")
+        while pos >= 0:
+            count += 1
+            pos = self._mmap.find("\n", pos + 1)
+        return count
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _bisect(self, key):
+        """Offset of the first line that is not lower than key"""
+        data = self._mmap
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind("\n", 0, mid) + 1
+            end = data.find("\n", start)
+            if data[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _scan(self, key):
+        """Yield the (path, pkgid) of the lines starting with key"""
+        if self._mmap is None:
+            return
+        data = self._mmap
+        pos = self._bisect(key)
+        while pos < self._size:
+            end = data.find("\n", pos)
+            line = data[pos:end]
+            if not line.startswith(key):
+                break
+            path, pkgid = line.split("\0", 1)
+            yield path, pkgid
+            pos = end + 1
+
+    def lookup(self, path):
+        """Return the pkgids of the packages owning path"""
+        return [pkgid for _, pkgid in self._scan(_encode(path) + "\0")]
+
+    def prefix(self, directory):
+        """Yield (path, pkgid) of all paths below directory"""
+        directory = _encode(directory).rstrip("/") + "/"
+        return self._scan(directory)
@@ -0,0 +1,276 @@
+"""Memory mapped columnar tables of the packages of a primary.xml
+
+The fields of the packages are ids into a single string table, the
+capabilities of each kind are arrays of string ids with per package
+offsets, and an array of the capabilities sorted by name answers lookups
+by binary search. Nothing is loaded when the file is opened, the pages
+read are shared through the OS page cache by all the processes that map
+the same file.
+
+The rows and PRCO lookups have the same form as MetadataDB ones, and the
+fields of a package can be read one by one from its row index.
+
+>>> import tempfile
+>>> fd, filename = tempfile.mkstemp()
+>>> PackageTable.build(filename, [{
+...     "pkgid": "a1", "name": "foo", "arch": "noarch", "epoch": "0",
+...     "version": "1.0", "release": "1", "location": "foo.rpm",
+...     "requires": [("bar", "GE", "0", "2", None)],
+...     "provides": [("foo", "EQ", "0", "1.0", "1")],
+... }, {
+...     "pkgid": "b2", "name": "bar", "arch": "x86_64", "epoch": "0",
+...     "version": "2.1", "release": "3", "location": "bar.rpm",
+...     "provides": [("bar", "EQ", "0", "2.1", "3"), ("libbar.so", None,
+...                                                   None, None, None)],
+... }, {
+...     "pkgid": "c3", "name": "bar", "arch": "src", "epoch": "0",
+...     "version": "2.1", "release": "3", "location": "bar.src.rpm",
+... }])
+>>> table = PackageTable(filename)
+>>> len(table)
+3
+>>> [row[:5] for row in table.packages()]
+[(0, 'a1', 'foo', 'noarch', '0'), (1, 'b2', 'bar', 'x86_64', '0')]
+>>> list(table.binary())
+[(0, 'a1', 'foo.rpm'), (1, 'b2', 'bar.rpm')]
+>>> table.field(1, "name"), table.field(1, "summary")
+('bar', None)
+>>> table.prco(0)["requires"]
+[('bar', 'GE', '0', '2', None)]
+>>> table.search_prco("provides", "bar")
+[('b2', 'bar', 'EQ', '0', '2.1', '3')]
+>>> table.search_prco("provides", "baz")
+[]
+>>> table.close()
+>>> os.unlink(filename)
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from .pathindex import _encode
+from .sqlitestore import _text
+
+MAGIC = "RPMTBL01"
+
+# the columns of a package, all string ids
+COLUMNS = (
+    "pkgid", "name", "arch", "epoch", "version", "release", "summary",
+    "description", "url", "packager", "sourcerpm", "license", "vendor",
+    "group", "location",
+)
+PRCO_KINDS = ("requires", "provides", "obsoletes", "conflicts")
+# package index, name, flags, epoch, version, release of a capability
+ENTRY_SIZE = 6
+
+# magic, number of packages, number of strings, number of capabilities of
+# each kind, then the offsets of the string offsets, string data, package
+# rows and of the offsets, entries and name order of each kind
+_HEADER = struct.Struct("<8sII4I" + "I" * (3 + 3 * len(PRCO_KINDS)))
+_UINT = struct.Struct("<I")
+_ROW = struct.Struct("<%dI" % len(COLUMNS))
+_ENTRY = struct.Struct("<%dI" % ENTRY_SIZE)
+
+# offset of each column in a row
+_COLUMN_OFFSETS = dict(
+    (column, _UINT.size * i) for i, column in enumerate(COLUMNS))
+_ARCH = COLUMNS.index("arch")
+
+
+def _uints(values=()):
+    return array.array("I", values)
+
+
+def _tobytes(uints):
+    if sys.byteorder == "big":
+        uints = array.array(uints.typecode, uints)
+        uints.byteswap()
+    return uints.tostring()
+
+
+class PackageTable(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _HEADER.unpack_from(self._mmap, 0)
+        if header[0] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a package table" % filename)
+        self._npackages, self._nstrings = header[1:3]
+        self._nentries = dict(zip(PRCO_KINDS, header[3:7]))
+        self._stroffsets, self._strdata, self._rows = header[7:10]
+        self._kinds = {}
+        for i, kind in enumerate(PRCO_KINDS):
+            self._kinds[kind] = header[10 + 3 * i:13 + 3 * i]
+
+    @staticmethod
+    def build(filename, packages):
+        """Write the table of an iterable of package dicts
+
+        The dicts are the same as for sqlitestore.build_primary.
+        """
+        strings = {}
+        strdata = []
+        stroffsets = _uints([0, 0])
+        size = [0]
+
+        def string_id(value):
+            if value is None:
+                return 0
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            elif not isinstance(value, str):
+                # epochs are ints once parsed
+                value = str(value)
+            sid = strings.get(value)
+            if sid is None:
+                sid = strings[value] = len(stroffsets) - 1
+                strdata.append(value)
+                size[0] += len(value)
+                stroffsets.append(size[0])
+            return sid
+
+        rows = _uints()
+        offsets = dict((kind, _uints([0])) for kind in PRCO_KINDS)
+        entries = dict((kind, _uints()) for kind in PRCO_KINDS)
+        npackages = 0
+        for index, pkg in enumerate(packages):
+            npackages += 1
+            rows.extend(string_id(pkg.get(column)) for column in COLUMNS)
+            for kind in PRCO_KINDS:
+                for entry in pkg.get(kind, ()):
+                    entries[kind].append(index)
+                    entries[kind].extend(string_id(value) for value in entry)
+                offsets[kind].append(len(entries[kind]) // ENTRY_SIZE)
+
+        sections = [_tobytes(stroffsets), "".join(strdata), _tobytes(rows)]
+        for kind in PRCO_KINDS:
+            kind_entries = entries[kind]
+            names = [
+                strdata[kind_entries[i * ENTRY_SIZE + 1] - 1]
+                for i in xrange(len(kind_entries) // ENTRY_SIZE)
+            ]
+            # sorted is stable, entries of a name stay in package order
+            order = sorted(xrange(len(names)), key=names.__getitem__)
+            sections.extend([
+                _tobytes(offsets[kind]), _tobytes(kind_entries),
+                _tobytes(_uints(order)),
+            ])
+
+        positions = []
+        position = _HEADER.size
+        for section in sections:
+            positions.append(position)
+            position += len(section)
+        header = _HEADER.pack(
+            MAGIC, npackages, len(strings) + 1,
+            *([len(entries[kind]) // ENTRY_SIZE for kind in PRCO_KINDS] +
+              positions)
+        )
+
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, "wb") as tmpfd:
+                tmpfd.write(header)
+                tmpfd.writelines(sections)
+            os.rename(tmpname, filename)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+    def __len__(self):
+        return self._npackages
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _string_data(self, sid):
+        start, end = struct.unpack_from(
+            "<II", self._mmap, self._stroffsets + 4 * sid)
+        return self._mmap[self._strdata + start:self._strdata + end]
+
+    def _string(self, sid):
+        if sid == 0:
+            return None
+        return _text(self._string_data(sid))
+
+    def _row(self, index):
+        return _ROW.unpack_from(self._mmap, self._rows + _ROW.size * index)
+
+    def field(self, index, column):
+        """Value of a column of the package at index"""
+        sid = _UINT.unpack_from(
+            self._mmap,
+            self._rows + _ROW.size * index + _COLUMN_OFFSETS[column])[0]
+        return self._string(sid)
+
+    def binary(self):
+        """Yield (index, pkgid, location) of the binary packages"""
+        for index in xrange(self._npackages):
+            if self.field(index, "arch") != "src":
+                yield (index, self.field(index, "pkgid"),
+                       self.field(index, "location"))
+
+    def packages(self):
+        """(index, pkgid, name, arch, epoch, version, release, summary,
+        description, url, packager, sourcerpm, license, vendor, group,
+        location) of the binary packages
+        """
+        result = []
+        for index in xrange(self._npackages):
+            row = self._row(index)
+            if self._string(row[_ARCH]) == "src":
+                continue
+            result.append((index,) + tuple(self._string(sid) for sid in row))
+        return result
+
+    def _entry(self, kind, i):
+        return _ENTRY.unpack_from(
+            self._mmap, self._kinds[kind][1] + _ENTRY.size * i)
+
+    def prco(self, index):
+        """{kind: [(name, flags, epoch, version, release)]} of a package"""
+        result = {}
+        for kind in PRCO_KINDS:
+            offsets = self._kinds[kind][0]
+            start, end = struct.unpack_from(
+                "<II", self._mmap, offsets + 4 * index)
+            result[kind] = [
+                tuple(self._string(sid) for sid in self._entry(kind, i)[1:])
+                for i in xrange(start, end)
+            ]
+        return result
+
+    def _order(self, kind, i):
+        return _UINT.unpack_from(self._mmap, self._kinds[kind][2] + 4 * i)[0]
+
+    def search_prco(self, kind, name):
+        """(pkgid, name, flags, epoch, version, release) of the named
+        entries of a kind
+        """
+        key = _encode(name)
+        lo, hi = 0, self._nentries[kind]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(kind, self._order(kind, mid))
+            if self._string_data(entry[1]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        for i in xrange(lo, self._nentries[kind]):
+            entry = self._entry(kind, self._order(kind, i))
+            if self._string_data(entry[1]) != key:
+                break
+            result.append(
+                (self._string(self._row(entry[0])[0]),) +
+                tuple(self._string(sid) for sid in entry[1:])
+            )
+        return result
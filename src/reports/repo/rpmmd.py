@@ -1,33 +1,699 @@
+import cPickle
+import errno
 import fcntl
-import gzip
-import io
+import functools
+import glob
+import hashlib
 import itertools
+import json
 import os
+import sys
 import tempfile
+import threading
+import time
 import traceback
 import urlparse
 import weakref
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import requests
 from lxml import etree
-
-from .rpmutils import evrcmp, EVR, split_rpm_filename
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .compression import StreamDecompressor, detect as detect_compression
+from .pathindex import PathIndex
+from .pkgtable import PackageTable
+from .rpmutils import evrcmp, evr_key, EVR, split_rpm_filename
+from .sqlitestore import (
+    MetadataDB, build_filelists, build_other, build_primary,
+)
+from .xmloffsets import ElementOffsets
+
+# Last repomd.xml fetched from the server and its HTTP cache validators
+REMOTE_REPOMD = "repomd.remote.xml"
+REMOTE_REPOMD_VALIDATORS = "repomd.remote.json"
+# Size of the chunks metadata downloads are streamed in
+CHUNK_SIZE = 256 * 1024
+
+# XML namespaces and tags of the metadata files
+NS_COMMON = "http://linux.duke.edu/metadata/common"
+NS_RPM = "http://linux.duke.edu/metadata/rpm"
+NS_FILELISTS = "http://linux.duke.edu/metadata/filelists"
+NS_OTHER = "http://linux.duke.edu/metadata/other"
+NS_PATTERN = "http://novell.com/package/metadata/suse/pattern"
+
+MD_TAGS = {
+    "primary": "{%s}package" % NS_COMMON,
+    "filelists": "{%s}package" % NS_FILELISTS,
+    "other": "{%s}package" % NS_OTHER,
+    "patterns": "{%s}pattern" % NS_PATTERN,
+}
+TAG_CHECKSUM = "{%s}checksum" % NS_COMMON
+TAG_LOCATION = "{%s}location" % NS_COMMON
+TAG_FORMAT = "{%s}format" % NS_COMMON
+PRCO_KINDS = ("requires", "provides", "obsoletes", "conflicts")
+TAG_FILE = "{%s}file" % NS_FILELISTS
+TAG_CHANGELOG = "{%s}changelog" % NS_OTHER
+# Capability flags, as the bitmask used by rpm
+LT = 2
+GT = 4
+EQ = 8
+LE = LT | EQ
+GE = GT | EQ
+# All the spellings of the flags found in metadata and yum API calls
+FLAGS = {
+    "GT": GT, "GE": GE, "EQ": EQ, "LE": LE, "LT": LT,
+    ">": GT, ">=": GE, "=": EQ, "<=": LE, "<": LT,
+    GT: GT, GE: GE, EQ: EQ, LE: LE, LT: LT,
+}
+FLAG_SYMBOLS = {GT: ">", GE: ">=", EQ: "=", LE: "<=", LT: "<"}
+FLAG_NAMES = {GT: "GT", GE: "GE", EQ: "EQ", LE: "LE", LT: "LT"}
+# On disk index of filelists.xml, see Repo.filelists
+FILELISTS_INDEX = "filelists.xml.index"
+# Path index of a filelists.xml, by checksum, see Repo.pathindex
+FILELISTS_PATHS = "filelists.xml.%s.paths"
+# SQLite database of a metadata file, by type and checksum, see Repo.db
+SQLITE_DB = "%s.xml.%s.sqlite"
+# Package table of a primary.xml, by checksum, see Repo.table
+PRIMARY_TABLE = "primary.xml.%s.table"
 
 
 class Session(object):
+    """Process wide pooled HTTP session used for all repo requests
+
+    Timeouts, retries and connection pool sizes are set with configure().
+    Simple counters of the traffic are available in stats.
+    """
     __state = {}
     _session = None
+    _stats = None
+    _lock = threading.Lock()
+
+    # (connect, read) timeouts in seconds
+    timeout = (10, 60)
+    # retries on connection errors and 5xx responses
+    retries = 3
+    backoff_factor = 0.5
+    # number of connections kept per host
+    pool_size = 10
 
     def __init__(self):
         self.__dict__ = self.__state
+        if self._stats is None:
+            self.reset_stats()
+
+    def configure(self, timeout=None, retries=None, backoff_factor=None,
+                  pool_size=None):
+        """Change session settings, the session is recreated on next use"""
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff_factor is not None:
+            self.backoff_factor = backoff_factor
+        if pool_size is not None:
+            self.pool_size = pool_size
+        self._session = None
 
     @property
     def session(self):
         if self._session is None:
-            self._session = requests.Session()
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+                max_retries=CountingRetry(
+                    total=self.retries,
+                    backoff_factor=self.backoff_factor,
+                    status_forcelist=(500, 502, 503, 504),
+                    raise_on_status=False,
+                ),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
         return self._session
 
+    def get(self, url, **kwargs):
+        breaker = CircuitBreaker()
+        if breaker.is_open(url):
+            raise ServerUnavailable(
+                "%s is unavailable" % CircuitBreaker.server(url))
+
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        try:
+            req = self.session.get(url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.count(requests=1, errors=1, latency=time.time() - start)
+            breaker.failure(url)
+            raise
+        self.count(requests=1, latency=time.time() - start)
+        if req.status_code >= 500:
+            breaker.failure(url)
+        else:
+            breaker.success(url)
+        if not kwargs.get("stream"):
+            self.count(bytes=len(req.content))
+        return req
+
+    def count(self, **counters):
+        with self._lock:
+            for key, value in counters.iteritems():
+                self._stats[key] += value
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = defaultdict(int)
+
+    @property
+    def stats(self):
+        """Counters of requests, errors, retries, bytes and latency"""
+        with self._lock:
+            stats = {
+                "requests": 0, "errors": 0, "retries": 0, "bytes": 0,
+                "latency": 0.0,
+            }
+            stats.update(self._stats)
+        if stats["requests"]:
+            stats["avg_latency"] = stats["latency"] / stats["requests"]
+        return stats
+
+
+class CountingRetry(Retry):
+    """Retry policy that counts the retries in Session().stats"""
+
+    def increment(self, *args, **kwargs):
+        retry = super(CountingRetry, self).increment(*args, **kwargs)
+        Session().count(retries=1)
+        return retry
+
+
+def fetch_repomd(baseurl, cachedir=None, ssl_verify=True, ttl=0):
+    """Fetch and parse repodata/repomd.xml of the repo at baseurl
+
+    When cachedir is given the fetched repomd.xml is kept there and trusted
+    without contacting the server for ttl seconds. After that it is
+    revalidated with a conditional GET, so an unchanged repo costs a 304
+    response without body. If the server can not be reached the cached copy
+    is used and marked stale.
+
+    Returns tuple (repomd, stale)
+
+    >>> import BaseHTTPServer, shutil
+    >>> files = {}
+    >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ...     def do_GET(self):
+    ...         body = files[self.path]
+    ...         etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    ...         if self.headers.get("If-None-Match") == etag:
+    ...             self.send_response(304)
+    ...             self.end_headers()
+    ...             return
+    ...         self.send_response(200)
+    ...         self.send_header("ETag", etag)
+    ...         self.end_headers()
+    ...         self.wfile.write(body)
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    >>> threading.Thread(target=server.serve_forever).start()
+    >>> baseurl = "http://127.0.0.1:%d/" % server.server_port
+    >>> def publish(revision):
+    ...     files["/repodata/repomd.xml"] = (
+    ...         "<repomd><revision>%s</revision></repomd>" % revision)
+    >>> cachedir = tempfile.mkdtemp()
+    >>> publish(1)
+    >>> repomd, stale = fetch_repomd(baseurl, cachedir)  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+
+    An unchanged repomd.xml is not downloaded again
+
+    >>> repomd, stale = fetch_repomd(baseurl, cachedir)  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 304
+    >>> repomd.findtext("revision"), stale
+    ('1', False)
+
+    Within the ttl the server is not contacted at all
+
+    >>> publish(2)
+    >>> repomd, stale = fetch_repomd(baseurl, cachedir, ttl=60)
+    >>> repomd.findtext("revision"), stale
+    ('1', False)
+    >>> repomd, stale = fetch_repomd(baseurl, cachedir)  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+    >>> repomd.findtext("revision"), stale
+    ('2', False)
+    >>> server.shutdown(); server.server_close(); shutil.rmtree(cachedir)
+    """
+    url = urlparse.urljoin(baseurl, "repodata/repomd.xml")
+    if cachedir is None:
+        req = Session().get(url, verify=ssl_verify)
+        print req.url
+        if not req.status_code == requests.codes.ok:
+            req.raise_for_status()
+        return etree.fromstring(req.content), False
+
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    cached_file = os.path.join(cachedir, REMOTE_REPOMD)
+    validators_file = os.path.join(cachedir, REMOTE_REPOMD_VALIDATORS)
+
+    headers = {}
+    if os.path.isfile(cached_file):
+        if time.time() - os.path.getmtime(cached_file) < ttl:
+            return _parse_cached_repomd(cached_file), False
+
+        try:
+            with open(validators_file) as fd:
+                validators = json.load(fd)
+        except (IOError, ValueError):
+            validators = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last-modified"):
+            headers["If-Modified-Since"] = validators["last-modified"]
+
+    try:
+        req = Session().get(url, headers=headers, verify=ssl_verify)
+        print req.url, req.status_code
+        if req.status_code >= 500:
+            req.raise_for_status()
+    except requests.exceptions.RequestException, exc:
+        if not os.path.isfile(cached_file):
+            raise
+        print "Using stale %s: %s" % (url, exc)
+        return _parse_cached_repomd(cached_file), True
+
+    if req.status_code == requests.codes.not_modified and headers:
+        # restart the freshness period
+        os.utime(cached_file, None)
+        return _parse_cached_repomd(cached_file), False
+
+    if not req.status_code == requests.codes.ok:
+        req.raise_for_status()
+
+    repomd = etree.fromstring(req.content)
+    _write_atomic(cached_file, req.content)
+    _write_atomic(validators_file, json.dumps({
+        "etag": req.headers.get("ETag"),
+        "last-modified": req.headers.get("Last-Modified"),
+    }))
+    return repomd, False
+
+
+class ServerUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker(object):
+    """Per server circuit breaker for repo servers
+
+    After `failures` consecutive failed requests to a server it is not
+    contacted for `cooldown` seconds. Requests to it fail immediately with
+    ServerUnavailable instead of waiting for the same timeout again.
+
+    >>> import shutil
+    >>> breaker = CircuitBreaker()
+    >>> url = "http://127.0.0.1:9/repo/"
+    >>> for i in range(breaker.failures):
+    ...     breaker.is_open(url), breaker.failure(url)
+    (False, None)
+    (False, None)
+    (False, None)
+    >>> breaker.is_open(url), breaker.open_servers
+    (True, ['http://127.0.0.1:9'])
+    >>> Session().get(url + "repodata/repomd.xml")
+    Traceback (most recent call last):
+        ...
+    ServerUnavailable: http://127.0.0.1:9 is unavailable
+
+    fetch_repomd serves the cached repomd.xml, if any, marked stale
+
+    >>> cachedir = tempfile.mkdtemp()
+    >>> fetch_repomd(url, cachedir)
+    Traceback (most recent call last):
+        ...
+    ServerUnavailable: http://127.0.0.1:9 is unavailable
+    >>> _write_atomic(os.path.join(cachedir, REMOTE_REPOMD),
+    ...               "<repomd><revision>1</revision></repomd>")
+    >>> repomd, stale = fetch_repomd(url, cachedir)  # doctest: +ELLIPSIS
+    Using stale http://127.0.0.1:9/repo/repodata/repomd.xml: ...unavailable
+    >>> repomd.findtext("revision"), stale
+    ('1', True)
+
+    The server is tried again after the cooldown or once a request succeeds
+
+    >>> cooldown = breaker.cooldown
+    >>> breaker.configure(cooldown=0)
+    >>> breaker.is_open(url)
+    False
+    >>> breaker.configure(cooldown=cooldown)
+    >>> breaker.success(url)
+    >>> breaker.is_open(url), breaker.open_servers
+    (False, [])
+    >>> shutil.rmtree(cachedir)
+    """
+    __state = {}
+    _servers = None
+    _lock = threading.Lock()
+
+    failures = 3
+    cooldown = 300
+
+    def __init__(self):
+        self.__dict__ = self.__state
+        if self._servers is None:
+            # server -> [consecutive failures, time of last failure]
+            self._servers = {}
+
+    def configure(self, failures=None, cooldown=None):
+        if failures is not None:
+            self.failures = failures
+        if cooldown is not None:
+            self.cooldown = cooldown
+
+    @staticmethod
+    def server(url):
+        parts = urlparse.urlsplit(url)
+        return "%s://%s" % (parts.scheme, parts.netloc)
+
+    def is_open(self, url):
+        with self._lock:
+            failures, last = self._servers.get(self.server(url), (0, 0))
+        return (
+            failures >= self.failures and
+            time.time() - last < self.cooldown
+        )
+
+    def success(self, url):
+        with self._lock:
+            self._servers.pop(self.server(url), None)
+
+    def failure(self, url):
+        server = self.server(url)
+        with self._lock:
+            failures = self._servers.get(server, (0, 0))[0]
+            self._servers[server] = (failures + 1, time.time())
+
+    @property
+    def open_servers(self):
+        return [
+            server for server in self._servers.keys()
+            if self.is_open(server)
+        ]
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+class ChecksumVerifier(object):
+    """Incrementally checksum data against a repomd.xml checksum element
+
+    Without the element (e.g. missing <open-checksum>) nothing is verified.
+    """
+    # Old createrepo versions use "sha" for sha1
+    ALIASES = {"sha": "sha1"}
+
+    def __init__(self, xml):
+        self._hash = None
+        self.expected = None
+        if xml is not None:
+            kind = xml.attrib.get("type", "sha256")
+            self._hash = hashlib.new(self.ALIASES.get(kind, kind))
+            self.expected = xml.text.strip()
+
+    def update(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def verify(self, name):
+        if self._hash is None:
+            return
+        actual = self._hash.hexdigest()
+        if actual != self.expected:
+            raise ChecksumError(
+                "Checksum mismatch for %s: expected %s, got %s" %
+                (name, self.expected, actual)
+            )
+
+
+def _md_checksum(mdfile):
+    """Checksum of a repomd.xml <data> element in form type:hexdigest"""
+    xml = mdfile.find("{*}checksum")
+    return "%s:%s" % (xml.attrib.get("type", "sha256"), xml.text.strip())
+
+
+def _parse_cached_repomd(cached_file):
+    with open(cached_file) as fd:
+        fcntl.lockf(fd, fcntl.LOCK_SH)
+        repomd = etree.parse(fd).getroot()
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+    return repomd
+
+
+def _cache_name(mdtype):
+    """Name of the decompressed metadata file of a type in the cachedir"""
+    if mdtype.endswith("_db"):
+        return mdtype + ".sqlite"
+    return mdtype + ".xml"
+
+
+def _write_atomic(filename, content):
+    """Write content to filename so that readers never see a partial file"""
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, "w") as tmpfd:
+            tmpfd.write(content)
+        os.rename(tmpname, filename)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+
+
+def _map(func, items, workers):
+    """map func on items with a pool of at most workers threads"""
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class RepoRegistry(object):
+    """Process wide LRU registry of parsed repos
+
+    Repos are keyed by (baseurl, revision) so that all views and diffs
+    served by one worker share the parsed metadata as long as the repo does
+    not change. Repos are registered unloaded and load their metadata on
+    first use. Least recently used repos are dropped once the estimated
+    size of the registered repos exceeds max_size bytes.
+
+    >>> import BaseHTTPServer, shutil, StringIO
+    >>> files = {}
+    >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ...     def do_GET(self):
+    ...         if self.path not in files:
+    ...             self.send_error(404)
+    ...             return
+    ...         self.send_response(200)
+    ...         self.end_headers()
+    ...         self.wfile.write(files[self.path])
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    >>> threading.Thread(target=server.serve_forever).start()
+    >>> baseurl = "http://127.0.0.1:%d/" % server.server_port
+    >>> primary = (
+    ...     '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+    ...     'xmlns:rpm="http://linux.duke.edu/metadata/rpm"><package>'
+    ...     '<name>foo</name><arch>noarch</arch>'
+    ...     '<version epoch="0" ver="1.0" rel="1"/>'
+    ...     '<checksum type="sha256" pkgid="YES">0123</checksum>'
+    ...     '<location href="foo-1.0-1.noarch.rpm"/></package></metadata>')
+    >>> def publish(revision, primary):
+    ...     href = "repodata/primary-%s.xml" % revision
+    ...     files["/repodata/repomd.xml"] = (
+    ...         '<repomd><revision>%s</revision><data type="primary">'
+    ...         '<location href="%s"/><checksum type="sha256">%s</checksum>'
+    ...         '</data></repomd>' % (
+    ...             revision, href, hashlib.sha256(primary).hexdigest()))
+    ...     return "/" + href
+    >>> href = publish(1, primary)
+    >>> registry = RepoRegistry()
+    >>> cachedir = tempfile.mkdtemp()
+    >>> def get():
+    ...     return registry.get("test", baseurl, cachedir=cachedir)
+    >>> repo = get()  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+
+    A repo whose metadata could not be downloaded is not used again
+
+    >>> stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+    >>> repo.packages is None  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/primary-1.xml
+    True
+    >>> sys.stderr, errors = stderr, sys.stderr.getvalue()
+    >>> repo.failed, errors.splitlines()[-1]  # doctest: +ELLIPSIS
+    (True, 'HTTPError: 404 Client Error: Not Found for url: http://...')
+    >>> files[href] = primary
+    >>> repo = get()  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+    >>> repo.packages  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/primary-1.xml
+    {'foo': <Package: foo noarch 1.0-1>}
+    >>> get() is repo  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+    True
+
+    Neither is a repo serving the cached revision because the new one could
+    not be downloaded
+
+    >>> href = publish(2, primary.replace("foo", "bar"))
+    >>> repo = get()  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+    >>> sys.stderr = StringIO.StringIO()
+    >>> repo.packages  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/primary-2.xml
+    {'foo': <Package: foo noarch 1.0-1>}
+    >>> sys.stderr = stderr
+    >>> repo.revision, repo.stale
+    ('1', True)
+    >>> files[href] = primary.replace("foo", "bar")
+    >>> repo = get()  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+    >>> repo.packages  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/primary-2.xml
+    {'bar': <Package: bar noarch 1.0-1>}
+    >>> repo.revision, repo.stale
+    ('2', False)
+
+    Unpickled packages get their repo from the registry
+
+    >>> po = cPickle.loads(cPickle.dumps(
+    ...     repo.packages["bar"], cPickle.HIGHEST_PROTOCOL))
+    >>> po.repo is repo  # doctest: +ELLIPSIS
+    http://127.0.0.1:.../repodata/repomd.xml 200
+    True
+    >>> po.filelist
+    ()
+    >>> po = Package.from_record(repo, po.location, po._record)
+    >>> po._repo = None
+    >>> po.filelist
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'NoneType' object has no attribute 'package_files'
+    >>> registry.clear()
+    >>> server.shutdown(); server.server_close(); shutil.rmtree(cachedir)
+    """
+    __state = {}
+    _repos = None
+    _lock = threading.RLock()
+    max_size = 512 * 1024 * 1024
+
+    def __init__(self):
+        self.__dict__ = self.__state
+        if self._repos is None:
+            self._repos = OrderedDict()
+
+    def get(self, repoid, baseurl, cachedir=None, ssl_verify=True, ttl=0):
+        if not baseurl.endswith("/"):
+            baseurl = baseurl + "/"
+        repomd, stale = fetch_repomd(
+            baseurl, cachedir=cachedir, ssl_verify=ssl_verify, ttl=ttl)
+        key = (baseurl, repomd.find("{*}revision").text)
+
+        with self._lock:
+            repo = self._repos.pop(key, None)
+            # a repo that failed to load, or fell back to the cached
+            # revision, is fetched again
+            if (
+                    repo is not None and repo.repoid == repoid and
+                    not repo.failed and repo.revision == key[1]
+            ):
+                # re-insert as most recently used
+                self._repos[key] = repo
+                repo.stale = stale
+                return repo
+
+        repo = Repo(
+            repoid, baseurl, cachedir=cachedir, ssl_verify=ssl_verify,
+            repomd=repomd, ttl=ttl, stale=stale,
+        )
+
+        with self._lock:
+            # older revisions of the same repo are not going to be used again
+            for old_key in self._repos.keys():
+                if old_key[0] == baseurl:
+                    del self._repos[old_key]
+            self._repos[key] = repo
+            self._evict()
+        return repo
+
+    def get_many(self, specs, workers=1, kinds=()):
+        """Get several repos using a bounded pool of fetcher threads
+
+        specs is a list of keyword argument dicts for get(). Returns the
+        repos in the same order, with None for repos that could not be
+        fetched. Only repomd.xml is fetched, unless kinds of metadata to
+        load are given, see Repo.ensure_loaded.
+        """
+        def _get(spec):
+            try:
+                repo = self.get(**spec)
+                if kinds:
+                    repo.ensure_loaded(kinds)
+                return repo
+            except requests.exceptions.RequestException, exc:
+                print exc
+                return None
+
+        repos = _map(_get, specs, workers)
+        if kinds:
+            with self._lock:
+                self._evict()
+        return repos
+
+    def ensure_loaded(self, repos, kinds=("primary",), workers=1):
+        """Load the metadata of several repos using a pool of threads
+
+        Returns the repos, see Repo.ensure_loaded.
+        """
+        _map(lambda repo: repo.ensure_loaded(kinds), repos, workers)
+        with self._lock:
+            self._evict()
+        return repos
+
+    def _evict(self):
+        for key, repo in self._repos.items():
+            if repo.failed:
+                del self._repos[key]
+        sizes = [repo.size for repo in self._repos.itervalues()]
+        total = sum(sizes)
+        # always keep the most recently used repo
+        while total > self.max_size and len(self._repos) > 1:
+            self._repos.popitem(last=False)
+            total -= sizes.pop(0)
+
+    def clear(self):
+        with self._lock:
+            self._repos.clear()
+
+    @property
+    def size(self):
+        return sum(repo.size for repo in self._repos.itervalues())
+
+    def __len__(self):
+        return len(self._repos)
+
 
 def str_eq(a, b):
     # TODO drop this on python3 port
@@ -38,31 +704,59 @@ def str_eq(a, b):
     return a == b
 
 
-def fast_iter(context):
-    """
-    http://stackoverflow.com/questions/12160418/why-is-lxml-etree-iterparse-eating-up-all-my-memory/12161078#12161078
-    http://lxml.de/parsing.html#modifying-the-tree
-    Based on Liza Daly's fast_iter
+def stream_iter(source, tag):
+    """Iterate over the `tag` elements of a metadata file
+
+    The iterated elements are direct children of the root. Only the exact
+    namespaced tag is matched and each element is removed from the root once
+    processed, so the tree never grows. Based on Liza Daly's fast_iter
     http://www.ibm.com/developerworks/xml/library/x-hiperfparse/
-    See also http://effbot.org/zone/element-iterparse.htm
-    Modified to act as a generator instead of using a callback
     """
+    context = etree.iterparse(
+        source, tag=tag, events=("end",), encoding='utf-8', recover=True
+    )
     for event, elem in context:
         yield elem
         # It's safe to call clear() here because no descendants will be
         # accessed
         elem.clear()
-        # Also eliminate now-empty references from the root node to elem
-        for ancestor in elem.xpath('ancestor-or-self::*'):
-            while ancestor.getprevious() is not None:
-                del ancestor.getparent()[0]
+        # Also drop the processed siblings from the root
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
     del context
 
 
+def _package_key(po):
+    """Key of the packages that are the same within a RepoSack
+
+    The per arch repos of a component all ship the same noarch packages
+    and share the repoid of the component, while a package shipped by
+    several components is kept once for each of them.
+    """
+    if po.checksum is None:
+        return id(po)
+    return (po.repoid, po.checksum)
+
+
+def _unique(packages):
+    """Yield the packages skipping those already seen, see _package_key"""
+    seen = set()
+    for po in packages:
+        key = _package_key(po)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield po
+
+
 class RepoSack(object):
     def __init__(self, repos):
         self.repos = repos
         self.ns = {}
+        self._newest = None
+        self._packages = None
 
     @property
     def base_packages(self):
@@ -72,9 +766,7 @@ class RepoSack(object):
 
     @property
     def packages(self):
-        return itertools.chain.from_iterable(
-            [repo.packages.viewitems() for repo in self.repos]
-        )
+        return ((po.name, po) for po in self.returnPackages())
 
     def get_ns(self, kind, nsmap):
         if kind not in self.ns:
@@ -86,10 +778,12 @@ class RepoSack(object):
         return self.ns[kind]
 
     def search_name(self, query):
+        seen = set()
         for repo in self.repos:
             for name in query:
                 po = repo.packages.get(name, None)
-                if po:
+                if po and (name, _package_key(po)) not in seen:
+                    seen.add((name, _package_key(po)))
                     yield (name, po)
 
     def search_basename(self, query):
@@ -122,62 +816,93 @@ class RepoSack(object):
                 yield (res, po)
 
     def search_provides(self, query):
-        for repo in self.repos:
-            for pr in query:
-                po = repo.provides.get(pr[0], None)
-                if po:
-                    yield (pr, po)
+        """Yield (requirement, package) for the packages providing it"""
+        for pr in query:
+            seen = set()
+            for repo in self.repos:
+                for po, _ in repo.capabilities("provides").match(pr):
+                    if _package_key(po) not in seen:
+                        seen.add(_package_key(po))
+                        yield (pr, po)
 
     def search_requires(self, query):
-        for repo in self.repos:
-            for qr in query:
-                po = repo.requires.get(qr[0], None)
-                if po:
-                    yield (qr, po)
+        """Yield (provide, package) for the packages requiring it"""
+        for qr in query:
+            seen = set()
+            for repo in self.repos:
+                for po, _ in repo.capabilities("requires").satisfied_by(qr):
+                    if _package_key(po) not in seen:
+                        seen.add(_package_key(po))
+                        yield (qr, po)
 
     def search_filenames(self, query):
+        """Search packages by file path
+
+        A query ending with "/" matches all the paths below that directory.
+        """
         pkgnames = set()
-        xp = None
         for repo in self.repos:
-            for pkg in fast_iter(repo.filelists_md):
-                if xp is None:
-                    xp = etree.XPath(
-                        "./common:file/text()",
-                        namespaces=self.get_ns("filelists", pkg.nsmap),
-                        smart_strings=False
-                    )
-                for filename in xp(pkg):
-                    if filename in query:
-                        pkgnames.add(pkg.attrib['name'])
+            if repo.pathindex is None:
+                continue
+            for path in query:
+                if path.endswith("/"):
+                    pkgids = set(
+                        pkgid for _, pkgid in repo.pathindex.prefix(path))
+                else:
+                    pkgids = repo.pathindex.lookup(path)
+                for pkgid in pkgids:
+                    po = repo.packages_by_pkgid.get(pkgid, None)
+                    if po is not None:
+                        pkgnames.add(po.name)
         return self.search_name(pkgnames)
 
     def searchNames(self, name):
-        for repo in self.repos:
-            po = repo.packages.get(name, None)
-            if po:
-                yield po
+        return _unique(
+            repo.packages[name] for repo in self.repos
+            if repo.packages.get(name, None)
+        )
 
     # Yum API emulation
     def returnPackages(self):
-        return itertools.chain.from_iterable(
-            [repo.packages.viewvalues() for repo in self.repos]
-        )
+        """All the packages of the repos, each pkgid once per repoid
 
-    def returnNewestByName(self, name=None):
-        newest = {}
-        for key, pkg in self.packages:
-            if name is not None and name != key:
-                continue
+        A package present in several repos of a component is returned from
+        the first one.
+        """
+        if self._packages is None:
+            self._packages = list(_unique(itertools.chain.from_iterable(
+                [repo.packages.viewvalues() for repo in self.repos]
+            )))
+        return iter(self._packages)
+
+    @property
+    def newest(self):
+        """{name: (EVR sort key, newest packages)} of all the repos
+
+        Merged once from the Repo.newest index of each repo.
+        """
+        if self._newest is None:
+            if len(self.repos) == 1:
+                self._newest = self.repos[0].newest
+            else:
+                newest = {}
+                for repo in self.repos:
+                    for name, (key, pkgs) in repo.newest.iteritems():
+                        if name not in newest or key > newest[name][0]:
+                            newest[name] = (key, list(pkgs))
+                        elif key == newest[name][0]:
+                            newest[name] = (key, list(_unique(
+                                newest[name][1] + pkgs)))
+                self._newest = newest
+        return self._newest
 
-            cval = 1
-            if key in newest:
-                cval = pkg.verCMP(newest[key][0])
-            if cval > 0:
-                newest[key] = [pkg]
-            elif cval == 0:
-                newest[key].append(pkg)
+    def returnNewestByName(self, name=None):
+        if name is not None:
+            if name not in self.newest:
+                return []
+            return list(self.newest[name][1])
         ret = []
-        for vals in newest.itervalues():
+        for _, vals in self.newest.itervalues():
             ret.extend(vals)
         return ret
 
@@ -200,17 +925,25 @@ class RepoSack(object):
     def searchFiles(self, name):
         """ Return list of packages by filename. """
         result = []
-        for po in self.returnPackages():
-            if name in po.files:
-                result.append(po)
-        return result
+        for repo in self.repos:
+            if repo.pathindex is None:
+                continue
+            for pkgid in repo.pathindex.lookup(name):
+                po = repo.packages_by_pkgid.get(pkgid, None)
+                if po is not None:
+                    result.append(po)
+        return list(_unique(result))
 
     def searchNevra(
         self, name=None, epoch=None, ver=None, rel=None, arch=None
     ):
         """return list of pkgobjects matching the nevra requested"""
         result = []
-        for po in self.returnPackages():
+        if name:
+            pkgs = self.searchNames(name)
+        else:
+            pkgs = self.returnPackages()
+        for po in pkgs:
             if (
                 (name and name != po.name) or
                 (epoch and epoch != po.epoch) or
@@ -235,10 +968,13 @@ class RepoSack(object):
         elif isinstance(version, basestring):
             version = EVR.from_string(version)
         result = {}
-        for po in self.returnPackages():
-            hits = po.matchingPrcos(kind, (name, flags, version))
-            if hits:
-                result[po] = hits
+        pkgs = {}
+        for repo in self.repos:
+            for po, hit in repo.capabilities(kind).match(
+                    (name, flags, version)):
+                # the same hits of a package shipped by an earlier repo
+                if pkgs.setdefault(_package_key(po), po) is po:
+                    result.setdefault(po, []).append(hit)
         if name[0] == '/':
             hit = (name, None, (None, None, None))
             for po in self.searchFiles(name):
@@ -246,8 +982,271 @@ class RepoSack(object):
         return result
 
 
+def _bisect(entries, evr, cmpfunc, right=False):
+    """bisect_left/bisect_right on the EVRs of sorted index entries"""
+    lo, hi = 0, len(entries)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        rc = cmpfunc(entries[mid][0], evr)
+        if rc < 0 or (right and rc == 0):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _evrcmp_norel(a, b):
+    return evrcmp(a, b, ignore_release=True)
+
+
+def _utf8(name):
+    if isinstance(name, unicode):
+        return name.encode("utf-8", "replace")
+    return name
+
+
+def _normalized(kind, po, cap):
+    """Capability of po as compared by Package.matchingPrcos"""
+    (n, f, (e, v, r)) = cap
+    f = FLAGS.get(f, f)
+    if f != EQ and kind == "provides":
+        if e is None:
+            e = po.epoch
+        if v is None:
+            v = po.ver
+        if r is None:
+            r = po.rel
+    return (n, f, (e, v, r))
+
+
+class CapabilityIndex(object):
+    """Index of the provides, requires, obsoletes or conflicts of a repo
+
+    Maps each capability name to its entries grouped by flag, each group
+    sorted by EVR, so versioned range queries only look at the entries
+    that can match. Those are then checked with rangeCompare, the results
+    are the same as with Package.matchingPrcos.
+
+    >>> class TestRepo(object):
+    ...     repoid = "test"
+    >>> def pkg(nevr, kind, *caps):
+    ...     name, evr = nevr.split(" ")
+    ...     record = PackageRecord()
+    ...     record.name, record.version = name, EVR.from_string(evr)
+    ...     setattr(record, kind, [
+    ...         Capability(n, f, EVR(*evr) if f else _NO_EVR)
+    ...         for n, f, evr in caps])
+    ...     return Package.from_record(TestRepo(), None, record)
+    >>> pkgs = [
+    ...     pkg("foo 1.0-1", "provides", ("libfoo", "EQ", (0, "1.0", "1"))),
+    ...     pkg("bar 2:0.5-1", "provides", ("libfoo", "EQ", (2, "0.5", "1"))),
+    ...     pkg("baz 1.5-2", "provides", ("libfoo", "EQ", (0, "1.5", None))),
+    ...     pkg("qux 1.2-1", "provides", ("libfoo", "LE", (None, None, None))),
+    ...     pkg("any 1-1", "provides", ("libfoo", None, None)),
+    ... ]
+    >>> provides = CapabilityIndex("provides", pkgs)
+    >>> def compare(results, expected):
+    ...     found = sorted(set(po.name for po, _ in results))
+    ...     return found, found == sorted(po.name for po in expected)
+    >>> for flag, evr in [
+    ...         ("EQ", ("0", "1.0", "1")), ("EQ", ("0", "1.0", None)),
+    ...         ("LT", ("0", "1.5", None)), ("GE", ("0", "1.2", "1")),
+    ...         ("GE", ("1", "0", None)), ("LE", ("0", "1.0", "1")),
+    ...         ("GE", (None, "1.0", None)), (None, (None, None, None))]:
+    ...     req = ("libfoo", flag, evr)
+    ...     print flag, evr, compare(provides.match(req), [
+    ...         po for po in pkgs if po.matchingPrcos("provides", req)])
+    EQ ('0', '1.0', '1') (['any', 'foo'], True)
+    EQ ('0', '1.0', None) (['any', 'foo'], True)
+    LT ('0', '1.5', None) (['any', 'foo', 'qux'], True)
+    GE ('0', '1.2', '1') (['any', 'bar', 'baz'], True)
+    GE ('1', '0', None) (['any', 'bar'], True)
+    LE ('0', '1.0', '1') (['any', 'foo', 'qux'], True)
+    GE (None, '1.0', None) (['any', 'baz', 'foo'], True)
+    None (None, None, None) (['any', 'bar', 'baz', 'foo', 'qux'], True)
+    >>> pkgs = [
+    ...     pkg("foo 1-1", "requires", ("libbar", "GE", ("0", "2.0", None))),
+    ...     pkg("bar 1-1", "requires", ("libbar", "LT", ("0", "2.0", "5"))),
+    ...     pkg("baz 1-1", "requires", ("libbar", "EQ", ("1", "1.0", None))),
+    ...     pkg("qux 1-1", "requires", ("libbar", None, None)),
+    ... ]
+    >>> requires = CapabilityIndex("requires", pkgs)
+    >>> for flag, evr in [
+    ...         ("EQ", ("0", "2.0", "1")), ("EQ", ("0", "2.0", None)),
+    ...         ("EQ", ("1", "1.0", "1")), ("GE", ("0", "3", None)),
+    ...         (None, (None, None, None))]:
+    ...     prov = ("libbar", flag, evr)
+    ...     print flag, evr, compare(requires.satisfied_by(prov), [
+    ...         po for po in pkgs for cap in po.requires
+    ...         if rangeCompare(cap, prov)])
+    EQ ('0', '2.0', '1') (['bar', 'foo', 'qux'], True)
+    EQ ('0', '2.0', None) (['foo', 'qux'], True)
+    EQ ('1', '1.0', '1') (['foo', 'qux'], True)
+    GE ('0', '3', None) (['baz', 'foo', 'qux'], True)
+    None (None, None, None) (['bar', 'baz', 'foo', 'qux'], True)
+    """
+
+    def __init__(self, kind, packages):
+        self.kind = kind
+        self._index = {}
+        for po in packages:
+            for cap in getattr(po, kind):
+                cap = _normalized(kind, po, cap)
+                (n, f, evr) = cap
+                flags = self._index.setdefault(_utf8(n), {})
+                flags.setdefault(f, []).append((EVR(*evr), cap, po))
+        for flags in self._index.itervalues():
+            for entries in flags.itervalues():
+                entries.sort(key=lambda entry: evr_key(entry[0]))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return _utf8(name) in self._index
+
+    def _candidates(self, entries, rcs, evr, sign, cmpfunc):
+        """Slice of entries that can compare to evr with a result in rcs
+
+        sign is 1 when the result is the comparison of the entry to evr,
+        -1 when it is the comparison of evr to the entry.
+        """
+        if rcs is None or cmpfunc is None:
+            return entries
+        if not rcs:
+            return []
+        left = _bisect(entries, evr, cmpfunc)
+        right = _bisect(entries, evr, cmpfunc, right=True)
+        regions = {
+            -sign: (0, left),
+            0: (left, right),
+            sign: (right, len(entries)),
+        }
+        return entries[min(regions[rc][0] for rc in rcs):
+                       max(regions[rc][1] for rc in rcs)]
+
+    def match(self, reqtuple):
+        """Return (package, capability) of the entries satisfying reqtuple"""
+        reqn, reqf, (reqe, reqv, reqr) = reqtuple
+        result = []
+        for flag, entries in self._index.get(_utf8(reqn), {}).iteritems():
+            if not flag or not reqf:
+                # unversioned satisfies everything
+                result.extend((po, cap) for _, cap, po in entries)
+                continue
+            # rangeCompare ignores the parts missing from the requirement,
+            # only the release can be left out without breaking the order
+            if reqe is None or reqv is None:
+                cmpfunc = None
+            elif reqr is None:
+                cmpfunc = _evrcmp_norel
+            else:
+                cmpfunc = evrcmp
+            candidates = self._candidates(
+                entries, _RANGE_RESULTS.get((FLAGS.get(reqf, reqf), flag)),
+                EVR(reqe, reqv, reqr), 1, cmpfunc)
+            result.extend(
+                (po, cap) for _, cap, po in candidates
+                if rangeCompare(reqtuple, cap)
+            )
+        return result
+
+    def satisfied_by(self, provtuple):
+        """Return (package, capability) of the entries provtuple satisfies"""
+        n, f, (e, v, r) = provtuple
+        result = []
+        for flag, entries in self._index.get(_utf8(n), {}).iteritems():
+            if not flag or not f:
+                result.extend((po, cap) for _, cap, po in entries)
+                continue
+            candidates = self._candidates(
+                entries, _RANGE_RESULTS.get((flag, FLAGS.get(f, f))),
+                EVR(e, v, r), -1, _evrcmp_norel if r is None else evrcmp)
+            result.extend(
+                (po, cap) for _, cap, po in candidates
+                if rangeCompare(cap, provtuple)
+            )
+        return result
+
+
+class CapabilityQuery(object):
+    """CapabilityIndex of a repo stored in a MetadataDB or PackageTable
+
+    Only the entries with the name looked up are loaded, through the name
+    index of the table, then checked with rangeCompare. The results are
+    the same as with CapabilityIndex.
+    """
+
+    def __init__(self, kind, source, packages):
+        self.kind = kind
+        self._source = source
+        # packages by pkgid
+        self._packages = packages
+
+    def _entries(self, name):
+        pool = InternPool()
+        for pkgid, n, f, e, v, r in self._source.search_prco(
+                self.kind, name):
+            po = self._packages.get(pkgid, None)
+            if po is not None:
+                yield po, _normalized(
+                    self.kind, po, pool.capability(n, f, e, v, r))
+
+    def match(self, reqtuple):
+        """Return (package, capability) of the entries satisfying reqtuple"""
+        return [
+            (po, cap) for po, cap in self._entries(reqtuple[0])
+            if rangeCompare(reqtuple, cap)
+        ]
+
+    def satisfied_by(self, provtuple):
+        """Return (package, capability) of the entries provtuple satisfies"""
+        return [
+            (po, cap) for po, cap in self._entries(provtuple[0])
+            if rangeCompare(cap, provtuple)
+        ]
+
+
+def _load_once(attr):
+    """Property of a Repo attribute that is loaded on first use
+
+    Loading runs under the lock of the repo, threads sharing a repo of the
+    RepoRegistry wait for the first one instead of loading it again. The
+    loaders only set the attribute once it is complete, as other threads
+    read it without the lock.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def getter(self):
+            value = getattr(self, attr)
+            if value is None:
+                with self._load_lock:
+                    value = func(self)
+            return value
+        return property(getter)
+    return decorator
+
+
+def _stored_prco(source, key):
+    """PRCO loader of a PackageRecord of a MetadataDB or PackageTable"""
+    pool = InternPool()
+    return dict(
+        (kind, [pool.capability(*entry) for entry in entries])
+        for kind, entries in source.prco(key).iteritems()
+    )
+
+
 class Repo(object):
-    def __init__(self, repoid, baseurl, cachedir=None, ssl_verify=True):
+    # Package storage, "memory", "sqlite" to query a MetadataDB or "mmap"
+    # to query a PackageTable
+    store = "memory"
+    # Query the SQLite databases published by the repo instead of the XML
+    upstream_db = True
+    # Parse the PRCO of primary.xml packages on first use, memory store only
+    header_only = True
+
+    def __init__(self, repoid, baseurl, cachedir=None, ssl_verify=True,
+                 repomd=None, ttl=0, stale=False):
         self.repoid = repoid
         self.baseurl = baseurl
         if not baseurl.endswith("/"):
@@ -261,25 +1260,87 @@ class Repo(object):
 
         self._cachedir = cachedir
         self._ssl_verify = ssl_verify
+        self._ttl = ttl
+        # True when serving cached metadata because the server is down
+        self.stale = stale
+        # True when the metadata could not be loaded, see RepoRegistry.get
+        self.failed = False
         self._revision = 0
         self._repomd = None
         self._mds = None
         self._patterns = None
         self._packages = None
         self._base_packages = None
+        self._newest = None
         self._changelogs = None
-        self._providx = None
-        self._reqidx = None
+        self._filelists = None
+        self._pathindex = None
+        self._pkgids = None
+        self._capidx = {}
+        self._db = None
+        self._table = None
+        self._load_lock = threading.RLock()
+
+        if repomd is not None:
+            self._repomd = repomd
+            self.revision = repomd.find("{*}revision").text
 
-        # Init cached properties
-        self.repomd
-        self.mds
-        self.packages
+    @property
+    def spec(self):
+        """Keyword arguments of RepoRegistry.get for this repo"""
+        return {
+            "repoid": self.repoid,
+            "baseurl": self.baseurl,
+            "cachedir": self._cachedir,
+            "ssl_verify": self._ssl_verify,
+            "ttl": self._ttl,
+        }
 
     def __repr__(self):
+        if self.stale:
+            return "<Repo: %s (stale)>" % self.baseurl
         return "<Repo: %s>" % self.baseurl
 
+    def prefetch(self):
+        """Fetch repomd.xml and download the metadata files, if needed
+
+        Nothing is parsed, see ensure_loaded.
+        """
+        self.mds
+        return self
+
+    def ensure_loaded(self, kinds=("primary",)):
+        """Load the metadata of the given kinds, unless already loaded
+
+        kinds are among "primary", "filelists", "other" and "patterns".
+        The repo is constructed without loading anything, the metadata is
+        otherwise loaded by the first use of the attributes that need it.
+        """
+        for kind in kinds:
+            if kind == "primary":
+                self.packages
+            elif kind == "filelists":
+                if self.use_db:
+                    self.db
+                else:
+                    self.filelists
+                    self.pathindex
+            elif kind == "other":
+                if self.use_db:
+                    self.db
+                else:
+                    self.changelogs
+            elif kind == "patterns":
+                self.patterns
+            else:
+                raise ValueError("Unknown metadata kind '%s'" % kind)
+        return self
+
     def read_cache(self, refresh=False):
+        """Refresh the cached metadata files if needed
+
+        Returns {mdtype: filename} of the cached files.
+        """
         cached_file = os.path.join(self._cachedir, "repomd.xml")
         cached_revision = None
 
@@ -290,63 +1351,246 @@ class Repo(object):
                 fcntl.lockf(fd, fcntl.LOCK_UN)
             cached_revision = cached.find("{*}revision").text
 
-        if cached_revision != self.revision or refresh:
-            self.refresh_cache()
+        # types not downloaded yet, e.g. after Repo.upstream_db changed
+        missing = [
+            mdtype for mdtype in self.md_types() if not os.path.isfile(
+                os.path.join(self._cachedir, _cache_name(mdtype)))
+        ]
+        if cached_revision != self.revision or refresh or missing:
+            try:
+                self.refresh_cache(force=refresh)
+            except requests.exceptions.RequestException:
+                if cached_revision is None:
+                    raise
+                # serve the last good metadata while the server is down
+                traceback.print_exc()
+                self._repomd = cached.getroot()
+                self.revision = cached_revision
+                self.stale = True
 
-        for mdfile in self.repomd.iterfind("{*}data"):
-            cached_file = os.path.join(
-                self._cachedir, mdfile.attrib["type"] + ".xml")
-            self._mds[mdfile.attrib["type"]] = cached_file
+        return dict(
+            (mdtype, os.path.join(self._cachedir, _cache_name(mdtype)))
+            for mdtype in self.md_types()
+        )
 
-        return True
+    def md_types(self):
+        """Types of the <data> of repomd.xml that are downloaded
 
-    def refresh_cache(self):
-        for mdfile in self.repomd.iterfind("{*}data"):
-            req = Session().session.get(
-                urlparse.urljoin(
-                    self.baseurl, mdfile.find("{*}location").attrib["href"]
-                ),
-                verify=self._ssl_verify,
-            )
-            print req.url
+        The SQLite databases published for primary, filelists and other
+        replace the XML files if Repo.upstream_db is set, otherwise they
+        are not downloaded.
+        """
+        types = [
+            mdfile.attrib["type"]
+            for mdfile in self.repomd.iterfind("{*}data")
+        ]
+        use_db = self.upstream_db and "primary_db" in types
+        skip = set()
+        for kind in ("primary", "filelists", "other"):
+            if use_db and kind + "_db" in types:
+                skip.add(kind)
+            else:
+                skip.add(kind + "_db")
+        return [mdtype for mdtype in types if mdtype not in skip]
+
+    def refresh_cache(self, force=False):
+        """Download the metadata files that changed since last refresh
+
+        The checksum of each metadata file in repomd.xml is recorded next to
+        the cached file, files whose checksum did not change are kept. The
+        cached files are only replaced once all downloads succeeded, so the
+        cache always holds a consistent revision.
+
+        >>> import BaseHTTPServer, shutil, zlib
+        >>> files = {}
+        >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        ...     def do_GET(self):
+        ...         self.send_response(200)
+        ...         self.end_headers()
+        ...         self.wfile.write(files[self.path])
+        ...     def log_message(self, *args):
+        ...         pass
+        >>> server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        >>> threading.Thread(target=server.serve_forever).start()
+        >>> def publish(revision, checksum=None, **contents):
+        ...     data = ""
+        ...     for mdtype, text in sorted(contents.items()):
+        ...         obj = zlib.compressobj(
+        ...             9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        ...         gz = obj.compress(text) + obj.flush()
+        ...         href = "repodata/%s.xml.gz" % mdtype
+        ...         files["/" + href] = gz
+        ...         data += (
+        ...             '<data type="%s"><location href="%s"/>'
+        ...             '<checksum type="sha256">%s</checksum>'
+        ...             '<open-checksum type="sha256">%s</open-checksum>'
+        ...             '</data>' % (
+        ...                 mdtype, href,
+        ...                 checksum or hashlib.sha256(gz).hexdigest(),
+        ...                 hashlib.sha256(text).hexdigest()))
+        ...     files["/repodata/repomd.xml"] = (
+        ...         "<repomd><revision>%s</revision>%s</repomd>" %
+        ...         (revision, data))
+        >>> def refresh():
+        ...     baseurl = "http://127.0.0.1:%d/" % server.server_port
+        ...     Repo("test", baseurl, cachedir=cachedir).refresh_cache()
+        >>> def cached(mdtype):
+        ...     with open(os.path.join(cachedir, _cache_name(mdtype))) as fd:
+        ...         return fd.read()
+        >>> cachedir = tempfile.mkdtemp()
+        >>> publish(1, primary="<metadata/>", other="<otherdata/>")
+        >>> refresh()  # doctest: +ELLIPSIS
+        http://127.0.0.1:.../repodata/repomd.xml 200
+        http://127.0.0.1:.../repodata/other.xml.gz
+        http://127.0.0.1:.../repodata/primary.xml.gz
+
+        Only the files whose checksum changed are downloaded
+
+        >>> publish(2, primary="<metadata/>", other="<otherdata></otherdata>")
+        >>> refresh()  # doctest: +ELLIPSIS
+        http://127.0.0.1:.../repodata/repomd.xml 200
+        http://127.0.0.1:.../repodata/other.xml.gz
+        >>> cached("primary"), cached("other")
+        ('<metadata/>', '<otherdata></otherdata>')
+
+        A download not matching its checksum fails and the cache is kept
+
+        >>> publish(3, "0" * 64, primary="<metadata></metadata>")
+        >>> refresh()  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ChecksumError: Checksum mismatch for http://...primary.xml.gz: ...
+        >>> cached("primary")
+        '<metadata/>'
+        >>> for name in sorted(os.listdir(cachedir)):
+        ...     print name
+        other.xml
+        other.xml.checksum
+        primary.xml
+        primary.xml.checksum
+        repomd.remote.json
+        repomd.remote.xml
+        repomd.xml
+        >>> server.shutdown(); server.server_close(); shutil.rmtree(cachedir)
+        """
+        downloaded = {}
+        mdtypes = self.md_types()
+        try:
+            for mdfile in self.repomd.iterfind("{*}data"):
+                mdtype = mdfile.attrib["type"]
+                if mdtype not in mdtypes:
+                    continue
+                checksum = _md_checksum(mdfile)
+                if (
+                        not force and
+                        checksum == self.cached_checksum(mdtype) and
+                        os.path.isfile(
+                            os.path.join(self._cachedir, _cache_name(mdtype)))
+                ):
+                    continue
+                downloaded[mdtype] = (self.download_md(mdfile), checksum)
+        except Exception:
+            for tmpname, checksum in downloaded.itervalues():
+                os.unlink(tmpname)
+            raise
+
+        for mdtype, (tmpname, checksum) in downloaded.iteritems():
+            os.rename(
+                tmpname, os.path.join(self._cachedir, _cache_name(mdtype)))
+            self.write_cache_file(
+                _cache_name(mdtype) + ".checksum", checksum + "\n")
+        self.write_cache_file("repomd.xml", etree.tostring(self.repomd))
+
+    def download_md(self, mdfile):
+        """Download and decompress the metadata file of a <data> element
+
+        The compression (gz, bz2, xz or zst) is detected from the magic bytes
+        and the location suffix. The response is streamed in chunks through
+        the decompressor to a temporary file in the cachedir, while verifying
+        both checksums from repomd.xml, so peak memory use does not depend on
+        the size of the metadata.
+
+        Returns the name of the temporary file, raises ChecksumError if the
+        checksums do not match.
+        """
+        mdtype = mdfile.attrib["type"]
+        href = mdfile.find("{*}location").attrib["href"]
+        req = Session().get(
+            urlparse.urljoin(self.baseurl, href),
+            verify=self._ssl_verify,
+            stream=True,
+        )
+        print req.url
+        try:
             if not req.status_code == requests.codes.ok:
                 req.raise_for_status()
 
-            with io.BytesIO(req.content) as fd:
-                gzfd = gzip.GzipFile(fileobj=fd)
-                self.write_cache_file(
-                    mdfile.attrib["type"] + ".xml", inputfd=gzfd)
-        self.write_cache_file(
-            "repomd.xml", content=etree.tostring(self.repomd))
+            checksum = ChecksumVerifier(mdfile.find("{*}checksum"))
+            open_checksum = ChecksumVerifier(mdfile.find("{*}open-checksum"))
+            decompressor = None
+            fd, tmpname = tempfile.mkstemp(
+                prefix=mdtype + ".", dir=self._cachedir)
+            try:
+                with os.fdopen(fd, "w") as outfd:
+                    for chunk in req.iter_content(CHUNK_SIZE):
+                        Session().count(bytes=len(chunk))
+                        if decompressor is None:
+                            decompressor = StreamDecompressor(
+                                detect_compression(href, chunk))
+                        checksum.update(chunk)
+                        data = decompressor.decompress(chunk)
+                        open_checksum.update(data)
+                        outfd.write(data)
+                    if decompressor is None:
+                        decompressor = StreamDecompressor(
+                            detect_compression(href))
+                    data = decompressor.flush()
+                    open_checksum.update(data)
+                    outfd.write(data)
+                checksum.verify(req.url)
+                open_checksum.verify(req.url + " (uncompressed)")
+            except Exception:
+                os.unlink(tmpname)
+                raise
+        finally:
+            req.close()
+        return tmpname
+
+    def cached_checksum(self, mdtype):
+        """Checksum of the cached metadata file of given type, if any"""
+        cached_file = os.path.join(
+            self._cachedir, _cache_name(mdtype) + ".checksum")
+        if not os.path.isfile(cached_file):
+            return None
+        with open(cached_file) as fd:
+            fcntl.lockf(fd, fcntl.LOCK_SH)
+            checksum = fd.read().strip()
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        return checksum
 
-    def write_cache_file(self, filename, content=None, inputfd=None):
+    def write_cache_file(self, filename, content):
         cached_file = os.path.join(self._cachedir, filename)
         with open(cached_file, "w") as fd:
             fcntl.lockf(fd, fcntl.LOCK_EX)
-            if content:
-                fd.write(content)
-            if inputfd:
-                fd.write(inputfd.read())
+            fd.write(content)
             fcntl.lockf(fd, fcntl.LOCK_UN)
 
-    @property
+    @_load_once("_repomd")
     def repomd(self):
         if self._repomd is None:
-            req = Session().session.get(
-                urlparse.urljoin(self.baseurl, "repodata/repomd.xml"),
-                verify=self._ssl_verify,
+            repomd, self.stale = fetch_repomd(
+                self.baseurl, cachedir=self._cachedir,
+                ssl_verify=self._ssl_verify, ttl=self._ttl,
             )
-            print req.url
-            if req.status_code == requests.codes.ok:
-                self._repomd = etree.fromstring(req.content)
-                self.revision = self._repomd.find("{*}revision").text
-            else:
-                req.raise_for_status()
+            self.revision = repomd.find("{*}revision").text
+            self._repomd = repomd
 
         return self._repomd
 
     @property
     def revision(self):
+        if self._repomd is None:
+            self.repomd
         return self._revision
 
     @revision.setter
@@ -354,115 +1598,404 @@ class Repo(object):
         self._revision = rev
 
     @property
+    def size(self):
+        """Rough estimate of the memory used by the parsed metadata
+
+        Based on the size of the uncompressed metadata that has been parsed.
+        """
+        size = 0
+        mds = self._mds or {}
+        loaded = [("primary", self._packages), ("other", self._changelogs)]
+        for kind, parsed in loaded:
+            mdfile = mds.get(kind) or mds.get(kind + "_db")
+            if parsed is not None and mdfile is not None:
+                try:
+                    size += os.path.getsize(mdfile)
+                except OSError:
+                    pass
+        return size
+
+    @_load_once("_mds")
     def mds(self):
         if self._mds is None:
-            self._mds = {}
-            if self.repomd is None:
-                return self._mds
-
-            try:
-                self.read_cache()
-            except Exception:
-                traceback.print_exc()
-                self._mds = {}
+            mds = {}
+            if self.repomd is not None:
+                try:
+                    mds = self.read_cache()
+                except Exception:
+                    traceback.print_exc()
+                    self.failed = True
+            self._mds = mds
 
         return self._mds
 
+    def iter_md(self, kind):
+        """Iterate over the package or pattern elements of a metadata file"""
+        return stream_iter(self.mds[kind], MD_TAGS[kind])
+
     @property
-    def primary_md(self):
-        return etree.iterparse(
-            self.mds["primary"],
-            tag="{*}package", events=("end",),
-            encoding='utf-8', recover=True
-        )
+    def patterns(self):
+        if self._patterns is None and 'patterns' in self.mds:
+            self._patterns = Patterns(self.iter_md("patterns"))
+        return self._patterns
+
+    @_load_once("_packages")
+    def packages(self):
+        if self._packages is None and self.has_primary:
+            packages = {}
+            repo = weakref.proxy(self)
+            source = self.package_source
+            if source is not None:
+                pkgs = self._stored_packages(repo, source)
+            elif self.header_only:
+                pkgs = self._header_packages(repo)
+            else:
+                pkgs = (Package(repo, xml) for xml in self.iter_md("primary"))
+            for po in pkgs:
+                if not po.arch == "src":
+                    packages[po.name] = po
+            self._packages = packages
+        return self._packages
 
     @property
-    def filelists_md(self):
-        return etree.iterparse(
-            self.mds["filelists"],
-            tag="{*}package", events=("end",),
-            encoding='utf-8', recover=True
-        )
+    def has_primary(self):
+        return "primary" in self.mds or "primary_db" in self.mds
 
     @property
-    def other_md(self):
-        return etree.iterparse(
-            self.mds["other"],
-            tag="{*}package", events=("end",),
-            encoding='utf-8', recover=True
-        )
+    def use_db(self):
+        """Whether the packages are queried from the MetadataDB
+
+        Set by Repo.store, or by the repo publishing its SQLite databases.
+        """
+        return self.store == "sqlite" or "primary_db" in self.mds
 
     @property
-    def patterns_md(self):
-        return etree.iterparse(
-            self.mds["patterns"],
-            tag="{*}pattern", events=("end",),
-            encoding='utf-8', recover=True
+    def package_source(self):
+        """MetadataDB or PackageTable the packages are loaded from
+
+        None when they are parsed from primary.xml.
+        """
+        if self.use_db:
+            return self.db
+        if self.store == "mmap":
+            return self.table
+        return None
+
+    def _header_packages(self, repo):
+        """Packages of primary.xml with their PRCO parsed on first use
+
+        PRCO is parsed again from the <package> at the same position in
+        the file.
+        """
+        offsets = ElementOffsets(self.mds["primary"], "package")
+        for index, xml in enumerate(self.iter_md("primary")):
+            yield Package(repo, xml, functools.partial(
+                _xml_prco, offsets, index, xml.findtext(TAG_CHECKSUM)))
+
+    def _fill_prco(self, kind):
+        """Parse a PRCO kind of the header only packages in a single pass
+
+        Used when the kind of all of them is needed by a CapabilityIndex,
+        the other kinds are still parsed for each package on first use.
+        """
+        slot = "_" + kind
+        pending = dict(
+            (po.checksum, po._record) for po in self.packages.viewvalues()
+            if getattr(po._record, slot) is None
         )
+        if not pending:
+            return
+        pool = InternPool()
+        for xml in self.iter_md("primary"):
+            record = pending.pop(xml.findtext(TAG_CHECKSUM), None)
+            if record is not None:
+                record._set_prco(_parse_prco(xml, pool, (kind,)), (kind,))
+            if not pending:
+                break
+
+    def _stored_packages(self, repo, source):
+        store = PackageStore()
+        if isinstance(source, PackageTable):
+            for index, pkgid, location in source.binary():
+                yield Package.from_record(
+                    repo, location,
+                    store.record(pkgid, TableRecord, source, index))
+            return
+        for row in source.packages():
+            yield Package.from_record(
+                repo, row[-1], store.record(row[1], PackageRecord.from_row,
+                                            source, row))
 
     @property
-    def patterns(self):
-        if self._patterns is None and 'patterns' in self.mds:
-            self._patterns = Patterns(self.patterns_md)
-        return self._patterns
+    def packages_by_pkgid(self):
+        if self._pkgids is None:
+            self._pkgids = dict(
+                (po.checksum, po) for po in self.packages.viewvalues())
+        return self._pkgids
+
+    @_load_once("_filelists")
+    def filelists(self):
+        """Files of the packages, as {pkgid: (files, dirs, ghosts)}
+
+        Built in a single pass over filelists.xml, then pickled to the
+        cachedir together with the checksum of the filelists.xml it was
+        built from, so it is only rebuilt when the metadata changes.
+        """
+        if self._filelists is None:
+            filelists = {}
+            if "filelists" in self.mds:
+                filelists = self._load_filelists()
+            self._filelists = filelists
+        return self._filelists
+
+    def _load_filelists(self):
+        index_file = os.path.join(self._cachedir, FILELISTS_INDEX)
+        checksum = self.cached_checksum("filelists")
+        if checksum is not None and os.path.isfile(index_file):
+            try:
+                with open(index_file, "rb") as fd:
+                    index_checksum, index = cPickle.load(fd)
+                if index_checksum == checksum:
+                    return index
+            except Exception:
+                traceback.print_exc()
+
+        index = dict(self._parse_filelists())
+        if checksum is not None:
+            _write_atomic(index_file, cPickle.dumps(
+                (checksum, index), cPickle.HIGHEST_PROTOCOL))
+        return index
+
+    def _parse_filelists(self):
+        """Yield (pkgid, (files, dirs, ghosts)) from filelists.xml"""
+        for xml in self.iter_md("filelists"):
+            files = []
+            dirs = []
+            ghosts = []
+            for item in xml.iterchildren(TAG_FILE):
+                kind = item.get("type")
+                if kind == "dir":
+                    dirs.append(item.text)
+                elif kind == "ghost":
+                    ghosts.append(item.text)
+                else:
+                    files.append(item.text)
+            yield xml.get("pkgid"), (tuple(files), tuple(dirs), tuple(ghosts))
+
+    def package_files(self, pkgid):
+        """(files, dirs, ghosts) of a package of the repo"""
+        if self.use_db and self.db is not None:
+            return self.db.files(pkgid)
+        return self.filelists.get(pkgid, _NO_FILES)
 
     @property
-    def packages(self):
-        if self._packages is None and 'primary' in self.mds:
-            self._packages = {}
-            for xml in fast_iter(self.primary_md):
-                Package(weakref.proxy(self), xml)
-        return self._packages
+    def pathindex(self):
+        """PathIndex of all the files, dirs and ghosts in filelists.xml
+
+        Written to the cachedir once per filelists.xml checksum and memory
+        mapped from there. None if the repo has no filelists. With the
+        sqlite store the MetadataDB answers the same queries.
+        """
+        if self.use_db:
+            if self.db is not None and self.db.has_filelists:
+                return self.db
+            return None
+        if self._pathindex is None and "filelists" in self.mds:
+            self._pathindex = PathIndex(self._checksum_file(
+                "filelists", FILELISTS_PATHS,
+                lambda filename: PathIndex.build(filename, (
+                    (path, pkgid)
+                    for pkgid, entries in self.filelists.iteritems()
+                    for names in entries
+                    for path in names
+                ))
+            ))
+        return self._pathindex
+
+    def _checksum_file(self, kind, pattern, build):
+        """Name of a file made from a metadata file, in the cachedir
+
+        pattern has a %s for the checksum of the metadata file. The file
+        is written by build(filename) unless it exists, those of other
+        checksums are removed.
+        """
+        checksum = self.cached_checksum(kind)
+        filename = os.path.join(
+            self._cachedir, pattern % (checksum or "").split(":")[-1])
+        if checksum is None or not os.path.isfile(filename):
+            for old in glob.glob(os.path.join(self._cachedir, pattern % "*")):
+                if old != filename:
+                    try:
+                        os.unlink(old)
+                    except OSError as exc:
+                        # removed by another worker rebuilding it too
+                        if exc.errno != errno.ENOENT:
+                            raise
+            build(filename)
+        return filename
+
+    @property
+    def newest(self):
+        """{name: (EVR sort key, [package])} for RepoSack.newest
+
+        A repo has a single package by name, built once per revision.
+        """
+        if self._newest is None:
+            self._newest = dict(
+                (name, (evr_key(po.version), [po]))
+                for name, po in self.packages.iteritems()
+            )
+        return self._newest
 
     @property
     def base_packages(self):
         if self._base_packages is None:
-            self._base_packages = defaultdict(list)
+            base_packages = defaultdict(list)
             for po in self.packages.viewvalues():
-                self._base_packages[po.basename].append(po)
+                base_packages[po.basename].append(po)
+            self._base_packages = base_packages
         return self._base_packages
 
-    @property
+    @_load_once("_changelogs")
     def changelogs(self):
         if self._changelogs is None:
-            self._changelogs = {}
-            for xml in fast_iter(self.other_md):
-                self._parse_chlog(xml)
+            changelogs = {}
+            for xml in self.iter_md("other"):
+                self._parse_chlog(xml, changelogs)
+            self._changelogs = changelogs
         return self._changelogs
 
-    def _parse_chlog(self, xml):
+    def _parse_chlog(self, xml, changelogs):
         if xml is None:
             return
         name = xml.attrib['name']
         po = self.packages.get(name, None)
         if po:
             basename = po.basename
-            if basename not in self._changelogs:
-                self._changelogs[basename] = [
+            if basename not in changelogs:
+                # the changelog of a package shared with another repo
+                # may have been parsed already, it is kept in the record
+                record = None
+                if xml.get("pkgid") == po.checksum:
+                    record = po._record
+                if record is not None and record.changelog_entries:
+                    changelogs[basename] = record.changelog_entries
+                    return
+                changelogs[basename] = [
                     Changelog(
                         entry.attrib['date'],
                         entry.attrib['author'],
                         text=entry.text
-                    ) for entry in xml.iterfind("{*}changelog")
+                    ) for entry in xml.iterfind(TAG_CHANGELOG)
                 ]
-
-    @property
-    def provides(self):
-        if self._providx is None:
-            self._providx = {}
-            for name, po in self.packages.viewitems():
-                for prov in po.provides:
-                    self._providx[prov.name] = po
-        return self._providx
-
-    @property
-    def requires(self):
-        if self._reqidx is None:
-            self._reqidx = {}
-            for name, po in self.packages.viewitems():
-                for req in po.requires:
-                    self._reqidx[req.name] = po
-        return self._reqidx
+                if record is not None:
+                    record.changelog_entries = changelogs[basename]
+
+    def package_changelog(self, po):
+        """Changelog entries of a package of the repo"""
+        if self.use_db and self.db is not None:
+            record = po._record
+            if record.changelog_entries is None:
+                record.changelog_entries = [
+                    Changelog(str(date), author, text=text)
+                    for author, date, text in self.db.changelog(po.checksum)
+                ]
+            return record.changelog_entries
+        return self.changelogs.get(po.basename, [])
+
+    def capabilities(self, kind):
+        """CapabilityIndex of the provides, requires, obsoletes or conflicts
+        """
+        if kind not in self._capidx:
+            source = self.package_source
+            if source is not None:
+                self._capidx[kind] = CapabilityQuery(
+                    kind, source, self.packages_by_pkgid)
+            else:
+                if self.header_only:
+                    self._fill_prco(kind)
+                self._capidx[kind] = CapabilityIndex(
+                    kind, self.packages.viewvalues())
+        return self._capidx[kind]
+
+    @_load_once("_db")
+    def db(self):
+        """MetadataDB of the primary, filelists and other metadata
+
+        The databases published by the repo are used as downloaded, the
+        others are built in the cachedir from the XML metadata, once per
+        checksum of the metadata file. None if the repo has no primary.
+        """
+        if self._db is None and self.has_primary:
+            files = {}
+            for kind in ("primary", "filelists", "other"):
+                if kind + "_db" in self.mds:
+                    files[kind] = self.mds[kind + "_db"]
+                elif kind in self.mds:
+                    files[kind] = self._sqlite_file(kind)
+            self._db = MetadataDB(**files)
+        return self._db
+
+    def _sqlite_file(self, kind):
+        checksum = self.cached_checksum(kind)
+
+        def build(filename):
+            if kind == "primary":
+                build_primary(filename, self._primary_rows(), checksum)
+            elif kind == "filelists":
+                build_filelists(filename, self._parse_filelists(), checksum)
+            else:
+                build_other(filename, self._parse_other(), checksum)
+        return self._checksum_file(kind, SQLITE_DB % (kind, "%s"), build)
+
+    @_load_once("_table")
+    def table(self):
+        """PackageTable of primary.xml
+
+        Written to the cachedir once per primary.xml checksum and memory
+        mapped from there. None if the repo has no primary.xml.
+        """
+        if self._table is None and "primary" in self.mds:
+            self._table = PackageTable(self._checksum_file(
+                "primary", PRIMARY_TABLE,
+                lambda filename: PackageTable.build(
+                    filename, self._primary_rows())
+            ))
+        return self._table
+
+    def _primary_rows(self):
+        """Yield the primary.xml packages as build_primary dicts"""
+        for xml in self.iter_md("primary"):
+            record = PackageRecord(xml)
+            location = xml.find(TAG_LOCATION)
+            row = dict(
+                (field, getattr(record, field)) for field in (
+                    "name", "arch", "summary", "description", "url",
+                    "packager", "sourcerpm", "license", "vendor", "group",
+                )
+            )
+            row.update(
+                pkgid=record.checksum,
+                epoch=record.version.epoch,
+                version=record.version.ver,
+                release=record.version.rel,
+                location=location.get("href")
+                if location is not None else None,
+            )
+            for kind in PackageRecord.PRCO_FIELDS.itervalues():
+                row[kind] = [
+                    (n, FLAG_NAMES.get(f, f), e, v, r)
+                    for (n, f, (e, v, r)) in getattr(record, kind)
+                ]
+            yield row
+
+    def _parse_other(self):
+        """Yield (pkgid, [(author, date, text)]) from other.xml"""
+        for xml in self.iter_md("other"):
+            yield xml.get("pkgid"), [
+                (entry.get("author"), int(entry.get("date")), entry.text)
+                for entry in xml.iterfind(TAG_CHANGELOG)
+            ]
 
 
 class Changelog(namedtuple("Changelog", ["time", "author_version", "text"])):
@@ -479,72 +2012,501 @@ class Changelog(namedtuple("Changelog", ["time", "author_version", "text"])):
 
 
 class Capability(namedtuple("Capability", ["name", "flag", "EVR"])):
-    def __str__(self):
+    """Capability entry, the flag is normalized to the rpm bitmask"""
+    __slots__ = ()
 
-        e, v, r = self.EVR
-        flags = {
-            'GT': '>',
-            'GE': '>=',
-            'EQ': '=',
-            'LT': '<',
-            'LE': '<='
-        }
+    def __new__(cls, name, flag, evr):
+        return super(Capability, cls).__new__(
+            cls, name, FLAGS.get(flag, flag), evr)
+
+    def __str__(self):
         if self.flag is None:
             return self.name
 
-        return '%s %s %s' % (self.name, flags[self.flag], self.EVR)
+        return '%s %s %s' % (self.name, FLAG_SYMBOLS[self.flag], self.EVR)
 
 
-class Package(object):
-    def __init__(self, repo, pkg):
-        self.repoid = repo.repoid
-        self.repo = repo
+_NO_EVR = EVR(None, None, None)
+_NO_FILES = ((), (), ())
+
+
+class InternPool(object):
+    """Process wide pool of the strings, EVRs and capabilities of packages
+
+    The same names, versions, licenses and sonames repeat across the
+    packages, arches and releases loaded together, the parser returns the
+    pooled object instead of keeping a new copy of each. The pool is
+    cleared once it holds max_size objects, objects already shared stay
+    shared. stats has the approximate number of bytes saved.
+    """
+    __state = {}
+
+    # number of pooled objects above which the pool is cleared
+    max_size = 1000000
+
+    def __init__(self):
+        self.__dict__ = self.__state
+        if not self.__state:
+            self.clear()
+
+    def clear(self):
+        self._strings = {}
+        self._evrs = {}
+        self._capabilities = {}
+        self.hits = 0
+        self.saved = 0
+
+    def _check_size(self):
+        if (len(self._strings) + len(self._evrs) +
+                len(self._capabilities)) >= self.max_size:
+            self.clear()
+
+    def string(self, value):
+        if value is None:
+            return None
+        pooled = self._strings.get(value)
+        if pooled is None:
+            self._check_size()
+            self._strings[value] = pooled = value
+        else:
+            self.hits += 1
+            self.saved += sys.getsizeof(value)
+        return pooled
+
+    def evr(self, epoch, ver, rel):
+        key = (epoch, ver, rel)
+        pooled = self._evrs.get(key)
+        if pooled is None:
+            self._check_size()
+            pooled = EVR(epoch, self.string(ver), self.string(rel))
+            self._evrs[key] = pooled
+        else:
+            self.hits += 1
+            self.saved += (
+                sys.getsizeof(pooled) + sys.getsizeof(ver or "") +
+                sys.getsizeof(rel or "")
+            )
+        return pooled
+
+    def capability(self, name, flag, epoch, ver, rel):
+        key = (name, flag, epoch, ver, rel)
+        pooled = self._capabilities.get(key)
+        if pooled is None:
+            self._check_size()
+            if flag is None:
+                # unversioned entries all share the same empty EVR
+                evr = _NO_EVR
+            else:
+                evr = self.evr(epoch, ver, rel)
+            pooled = Capability(self.string(name), flag, evr)
+            self._capabilities[key] = pooled
+        else:
+            self.hits += 1
+            self.saved += sys.getsizeof(pooled) + sys.getsizeof(name)
+            if flag is not None:
+                self.saved += (
+                    sys.getsizeof(pooled.EVR) + sys.getsizeof(ver or "") +
+                    sys.getsizeof(rel or "")
+                )
+        return pooled
+
+    @property
+    def stats(self):
+        return {
+            "strings": len(self._strings),
+            "evrs": len(self._evrs),
+            "capabilities": len(self._capabilities),
+            "hits": self.hits,
+            "saved": self.saved,
+        }
+
+
+def _parse_capabilities(xml, pool):
+    """Capabilities of the entries of a <rpm:provides> or similar element"""
+    return [
+        pool.capability(
+            entry.get("name"), entry.get("flags"),
+            entry.get("epoch"), entry.get("ver"), entry.get("rel"),
+        ) for entry in xml.iterchildren()
+    ]
+
+
+def _parse_prco(pkg, pool, kinds=PRCO_KINDS):
+    """{kind: capabilities} of a primary.xml <package> element"""
+    prco = {}
+    for elem in pkg.iterfind(TAG_FORMAT + "/*"):
+        field = PackageRecord.PRCO_FIELDS.get(elem.tag)
+        if field in kinds:
+            prco[field] = _parse_capabilities(elem, pool)
+    return prco
+
+
+def _offset_package(offsets, index, pkgid):
+    """<package> element of pkgid, expected at index of the offsets"""
+    pkg = offsets.element(index)
+    if pkg.findtext(TAG_CHECKSUM) != pkgid:
+        index = offsets.index(">%s</" % pkgid)
+        if index is not None:
+            pkg = offsets.element(index)
+        if index is None or pkg.findtext(TAG_CHECKSUM) != pkgid:
+            raise ValueError("%s is not in %s" % (pkgid, offsets.filename))
+    return pkg
+
+
+def _xml_prco(offsets, index, pkgid):
+    """PRCO loader of a PackageRecord parsed without it from primary.xml
+
+    The <package> is looked up by pkgid when the one at index is another,
+    and by a pass over the file when the offsets do not have it.
+    """
+    pool = InternPool()
+    try:
+        return _parse_prco(_offset_package(offsets, index, pkgid), pool)
+    except ValueError:
+        traceback.print_exc()
+    for pkg in stream_iter(offsets.filename, MD_TAGS["primary"]):
+        if pkg.findtext(TAG_CHECKSUM) == pkgid:
+            return _parse_prco(pkg, pool)
+    # the cached file was replaced by another revision meanwhile
+    return {}
+
+
+def _prco_property(kind):
+    """Property of the PRCO of a record, loaded by its _loader if None"""
+    slot = "_" + kind
+
+    def fget(self):
+        value = getattr(self, slot)
+        if value is None:
+            self._load_prco()
+            value = getattr(self, slot)
+        return value
+
+    def fset(self, value):
+        setattr(self, slot, value)
+    return property(fget, fset)
+
+
+def _set_prco(record, prco, kinds=None):
+    """Set the PRCO kinds of a record that are not loaded yet from prco
+
+    The loader of the record is dropped once all the kinds are loaded.
+    """
+    for kind in kinds or PRCO_KINDS:
+        if getattr(record, "_" + kind) is None:
+            setattr(record, "_" + kind, prco.get(kind, []))
+    if all(getattr(record, "_" + kind) is not None for kind in PRCO_KINDS):
+        record._loader = None
+
+
+def _record_state(record):
+    """Pickled state of a PackageRecord or TableRecord, PRCO included"""
+    return dict(
+        (key, getattr(record, key.lstrip("_")))
+        for key in PackageRecord.__slots__
+        if key not in ("__weakref__", "_loader")
+    )
+
+
+class PackageRecord(object):
+    """Fields of a package parsed from a primary.xml <package> element
+
+    All needed fields are extracted when parsing, so that no part of the
+    lxml tree is kept alive. Records are shared, through the PackageStore,
+    by the Package of every repo that ships the same package.
+    """
+    __slots__ = (
+        "name", "arch", "version", "checksum", "summary", "description",
+        "url", "packager", "sourcerpm", "license", "vendor", "group",
+        "_requires", "_provides", "_obsoletes", "_conflicts", "_loader",
+        "changelog_entries", "__weakref__",
+    )
+
+    # children of <format> stored as plain text
+    FORMAT_FIELDS = {
+        "{%s}sourcerpm" % NS_RPM: "sourcerpm",
+        "{%s}license" % NS_RPM: "license",
+        "{%s}vendor" % NS_RPM: "vendor",
+        "{%s}group" % NS_RPM: "group",
+    }
+    # children of <format> holding capability entries
+    PRCO_FIELDS = {
+        "{%s}requires" % NS_RPM: "requires",
+        "{%s}provides" % NS_RPM: "provides",
+        "{%s}obsoletes" % NS_RPM: "obsoletes",
+        "{%s}conflicts" % NS_RPM: "conflicts",
+    }
+
+    def __init__(self, pkg=None, loader=None):
         self.name = None
-        self.checksum = None
-        self.version = EVR(None, None, None)
         self.arch = None
-        self._sourcerpm = None
-        self._license = None
-        self._group = None
-        self._vendor = None
-        self.description = None
+        self.version = _NO_EVR
+        self.checksum = None
         self.summary = None
-        self._filelist = None
-        self._ghost = None
-        self._dir = None
-        self._conflicts = None
-        self._requires = None
-        self._provides = None
-        self._obsoletes = None
+        self.description = None
+        self.url = None
+        self.packager = None
+        self.sourcerpm = ""
+        self.license = ""
+        self.vendor = ""
+        self.group = ""
+        # callable returning {kind: capabilities} for PRCO loaded on use,
+        # the PRCO of pkg is then not parsed
+        self._loader = loader
+        for kind in PRCO_KINDS:
+            setattr(self, "_" + kind, [] if loader is None else None)
+        # changelog entries from other.xml, set by Repo.changelogs
+        self.changelog_entries = None
+        if pkg is None:
+            return
 
+        pool = InternPool()
         for elem in pkg.iterchildren():
-            if etree.QName(elem.tag).localname == "location":
-                self.location = elem.attrib["href"]
-            elif etree.QName(elem.tag).localname == "version":
-                self.version = EVR(
-                    elem.attrib["epoch"],
-                    elem.attrib["ver"],
-                    elem.attrib["rel"]
-                )
-            elif etree.QName(elem.tag).localname == "format":
-                self.format_xml = elem
-            else:
-                setattr(self, etree.QName(elem.tag).localname, elem.text)
+            tag = elem.tag
+            tag = tag[tag.find("}") + 1:]
+            if tag == "name":
+                self.name = pool.string(elem.text)
+            elif tag == "arch":
+                self.arch = pool.string(elem.text)
+            elif tag == "version":
+                self.version = pool.evr(
+                    elem.get("epoch"), elem.get("ver"), elem.get("rel"))
+            elif tag == "format":
+                self._parse_format(elem, pool)
+            elif tag == "packager":
+                self.packager = pool.string(elem.text)
+            elif tag in ("checksum", "summary", "description", "url"):
+                setattr(self, tag, elem.text)
+
+    def _parse_format(self, xml, pool):
+        for elem in xml.iterchildren():
+            field = self.FORMAT_FIELDS.get(elem.tag)
+            if field is not None:
+                setattr(self, field, pool.string(elem.text or ""))
+                continue
+            field = self.PRCO_FIELDS.get(elem.tag)
+            if field is not None and self._loader is None:
+                setattr(self, field, _parse_capabilities(elem, pool))
+
+    @classmethod
+    def from_row(cls, source, row):
+        """Record of a row of the packages of a MetadataDB
+
+        PRCO is loaded from the source on first use.
+        """
+        pool = InternPool()
+        record = cls(loader=functools.partial(_stored_prco, source, row[0]))
+        (_, record.checksum, name, arch, epoch, ver, rel,
+         record.summary, record.description, record.url, packager,
+         sourcerpm, license, vendor, group, _) = row
+        record.name = pool.string(name)
+        record.arch = pool.string(arch)
+        record.version = pool.evr(epoch, ver, rel)
+        record.packager = pool.string(packager)
+        record.sourcerpm = pool.string(sourcerpm or "")
+        record.license = pool.string(license or "")
+        record.vendor = pool.string(vendor or "")
+        record.group = pool.string(group or "")
+        return record
+
+    def _load_prco(self):
+        self._set_prco(self._loader())
+
+    _set_prco = _set_prco
+
+    requires = _prco_property("requires")
+    provides = _prco_property("provides")
+    obsoletes = _prco_property("obsoletes")
+    conflicts = _prco_property("conflicts")
+
+    def __getstate__(self):
+        return _record_state(self)
+
+    def __setstate__(self, state):
+        self._loader = None
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
+
+class TableRecord(object):
+    """Record of a row of a PackageTable, with the PackageRecord fields
+
+    Only the table and the row index are held, the fields are read from
+    the memory mapped table when used and PRCO is loaded on first use, so
+    the package data stays in the pages shared by all the processes. It
+    is pickled as a PackageRecord.
+    """
+    __slots__ = (
+        "_table", "_index", "_requires", "_provides", "_obsoletes",
+        "_conflicts", "_loader", "changelog_entries", "__weakref__",
+    )
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+        # shared by all the records instead of a partial for each
+        self._loader = _stored_prco
+        self._requires = self._provides = None
+        self._obsoletes = self._conflicts = None
+        self.changelog_entries = None
+
+    def _column_property(column, default=None):
+        def fget(self):
+            value = self._table.field(self._index, column)
+            return default if value is None else value
+        return property(fget)
+
+    name = _column_property("name")
+    arch = _column_property("arch")
+    checksum = _column_property("pkgid")
+    summary = _column_property("summary")
+    description = _column_property("description")
+    url = _column_property("url")
+    packager = _column_property("packager")
+    sourcerpm = _column_property("sourcerpm", "")
+    license = _column_property("license", "")
+    vendor = _column_property("vendor", "")
+    group = _column_property("group", "")
+    del _column_property
+
+    @property
+    def version(self):
+        field = self._table.field
+        return EVR(field(self._index, "epoch"), field(self._index, "version"),
+                   field(self._index, "release"))
 
-        if not self.arch == "src":
-            self.repo._packages[self.name] = self
+    def _load_prco(self):
+        self._set_prco(self._loader(self._table, self._index))
 
-    def __repr__(self):
-        return "<Package: %s %s %s>" % (self.name, self.arch, self.version)
+    _set_prco = _set_prco
+
+    requires = _prco_property("requires")
+    provides = _prco_property("provides")
+    obsoletes = _prco_property("obsoletes")
+    conflicts = _prco_property("conflicts")
+
+    def __reduce__(self):
+        return (PackageRecord, (), _record_state(self))
+
+
+class PackageStore(object):
+    """Process wide store of the PackageRecords by pkgid
+
+    Consecutive releases share most of their packages, a package that is
+    already loaded for another repo is not parsed again and its record is
+    shared. Records are held weakly and go away with the last repo that
+    references them.
+    """
+    __state = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.__dict__ = self.__state
+        if not self.__state:
+            self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._records = weakref.WeakValueDictionary()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, pkg, loader=None):
+        """Record of a primary.xml <package> element, parsed if needed
+
+        With a PRCO loader, the PRCO of pkg is not parsed.
+        """
+        return self.record(
+            pkg.findtext(TAG_CHECKSUM), PackageRecord, pkg, loader)
+
+    def record(self, pkgid, factory, *args):
+        """Record of pkgid, made by factory(*args) if not in the store"""
+        with self._lock:
+            record = self._records.get(pkgid) if pkgid else None
+            if record is not None:
+                self.hits += 1
+                return record
+        record = factory(*args)
+        with self._lock:
+            if pkgid:
+                # keep the record another thread may have stored meanwhile
+                record = self._records.setdefault(pkgid, record)
+            self.misses += 1
+        return record
+
+    @property
+    def stats(self):
+        return {
+            "records": len(self._records),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class Package(object):
+    """Package of a repo
+
+    A view of the shared PackageRecord with the repo specific fields, the
+    fields of the record are available as attributes. Packages can be
+    pickled, unpickled packages get their repo from the RepoRegistry on
+    first use.
+    """
+    __slots__ = (
+        "repoid", "_repo", "_spec", "location", "_record", "__weakref__")
+
+    def __init__(self, repo, pkg, loader=None):
+        self.repoid = repo.repoid
+        self._repo = repo
+        self._spec = None
+        location = pkg.find(TAG_LOCATION)
+        self.location = location.get("href") if location is not None else None
+        self._record = PackageStore().get(pkg, loader)
+
+    @classmethod
+    def from_record(cls, repo, location, record):
+        po = cls.__new__(cls)
+        po.repoid = repo.repoid
+        po._repo = repo
+        po._spec = None
+        po.location = location
+        po._record = record
+        return po
+
+    def __getattr__(self, name):
+        attr = getattr(type(self), name, None)
+        if isinstance(attr, property):
+            # raised by the property itself, not a missing record field
+            return attr.fget(self)
+        if attr is not None:
+            # unset slot
+            raise AttributeError(name)
+        return getattr(self._record, name)
+
+    def __getstate__(self):
+        return {
+            "repoid": self.repoid,
+            "location": self.location,
+            "_record": self._record,
+            "_spec": self._spec if self._repo is None else self._repo.spec,
+        }
+
+    def __setstate__(self, state):
+        self._repo = None
+        self._spec = None
+        for key, value in state.iteritems():
+            setattr(self, key, value)
 
     @property
-    def sourcerpm(self):
-        if self._sourcerpm is None:
-            xml = self.format_xml.find("{*}sourcerpm")
-            self._sourcerpm = ""
-            if xml is not None:
-                self._sourcerpm = xml.text
-        return self._sourcerpm
+    def repo(self):
+        if self._repo is None and self._spec is not None:
+            self._repo = RepoRegistry().get(**self._spec)
+        return self._repo
+
+    def __repr__(self):
+        return "<Package: %s %s %s>" % (self.name, self.arch, self.version)
 
     @property
     def basename(self):
@@ -565,121 +2527,24 @@ class Package(object):
     def rel(self):
         return self.version[2]
 
-    @property
-    def license(self):
-        if self._license is None:
-            xml = self.format_xml.find("{*}license")
-            self._license = ""
-            if xml is not None:
-                self._license = xml.text
-        return self._license
-
-    @property
-    def vendor(self):
-        if self._vendor is None:
-            xml = self.format_xml.find("{*}vendor")
-            self._vendor = ""
-            if xml is not None:
-                self._vendor = xml.text
-        return self._vendor
-
-    @property
-    def group(self):
-        if self._group is None:
-            xml = self.format_xml.find("{*}group")
-            self._group = ""
-            if xml is not None:
-                self._group = xml.text
-        return self._group
-
-    def _set_prco(self, kind):
-        xml = self.format_xml.find("{*}%s" % kind)
-        if xml is None:
-            return []
-        return [
-            Capability(
-                entry.attrib["name"],
-                entry.attrib.get("flags", None),
-                EVR(
-                    entry.attrib.get("epoch", None),
-                    entry.attrib.get("ver", None),
-                    entry.attrib.get("rel", None),
-                ),
-            ) for entry in xml.iterfind("{*}entry")
-        ]
-
-    @property
-    def requires(self):
-        if self._requires is None:
-            self._requires = self._set_prco("requires")
-        return self._requires
-
-    @property
-    def provides(self):
-        if self._provides is None:
-            self._provides = self._set_prco("provides")
-        return self._provides
-
-    @property
-    def obsoletes(self):
-        if self._obsoletes is None:
-            self._obsoletes = self._set_prco("obsoletes")
-        return self._obsoletes
-
-    @property
-    def conflicts(self):
-        if self._conflicts is None:
-            self._conflicts = self._set_prco("conflicts")
-        return self._conflicts
-
-    @conflicts.setter
-    def conflicts(self, xml):
-        self._conflicts = self._prco_xml_to_list(xml)
-
-    def _set_filelists(self):
-        self._filelist = []
-        self._ghosts = []
-        self._dirs = []
-        for xml in fast_iter(self.repo.filelists_md):
-            self._parse_filelists(xml)
-
-    def _parse_filelists(self, xml):
-        if xml is None:
-            return
-
-        if xml.attrib["pkgid"] != self.checksum:
-            return
-
-        for item in xml.iterchildren():
-            tag = etree.QName(item.tag).localname
-            if tag == "file":
-                self._filelist.append(item.text)
-            elif tag == "dir":
-                self._dirs.append(item.text)
-            elif tag == "ghost":
-                self._ghosts.append(item.text)
+    def _files(self):
+        return self.repo.package_files(self.checksum)
 
     @property
     def filelist(self):
-        if self._filelist is None:
-            self._set_filelists()
-        return self._filelist
+        return self._files()[0]
 
     @property
     def dirs(self):
-        if self._dirs is None:
-            self._set_filelists()
-        return self._dirs
+        return self._files()[1]
 
     @property
     def ghosts(self):
-        if self._ghosts is None:
-            self._set_filelists()
-        return self._ghosts
+        return self._files()[2]
 
     @property
     def changelog(self):
-        return self.repo.changelogs.get(self.basename, [])
+        return self.repo.package_changelog(self)
 
     @property
     def prco(self):
@@ -708,22 +2573,21 @@ class Package(object):
         }
 
     def verCMP(self, other):
-        return evrcmp(self.version, other.version)
+        return cmp(evr_key(self.version), evr_key(other.version))
 
     def inPrcoRange(self, prcotype, reqtuple):
         return bool(self.matchingPrcos(prcotype, reqtuple))
 
     def matchingPrcos(self, prcotype, reqtuple):
-        (reqn, reqf, (reqe, reqv, reqr)) = reqtuple
-        # find the named entry in pkgobj, do the comparsion
-        result = []
+        reqn = reqtuple[0]
+        # find the named entries in pkgobj, then compare them all at once
+        named = []
         for (n, f, (e, v, r)) in self.prco.get(prcotype, []):
             if not str_eq(reqn, n):
                 continue
 
-            if f == '=':
-                f = 'EQ'
-            if f != 'EQ' and prcotype == 'provides':
+            f = FLAGS.get(f, f)
+            if f != EQ and prcotype == 'provides':
                 # isn't this odd, it's not 'EQ' and it is a provides
                 # - it really should be EQ
                 # use the pkgobj's evr for the comparison
@@ -733,19 +2597,15 @@ class Package(object):
                     v = self.ver
                 if r is None:
                     r = self.rel
+            named.append((n, f, (e, v, r)))
 
-            matched = rangeCompare(
-                reqtuple, (n, f, (e, v, r)))
-            if matched:
-                result.append((n, f, (e, v, r)))
-
-        return result
+        return rangeCompareAll(reqtuple, named)
 
 
 class Patterns(object):
-    def __init__(self, patxml):
+    def __init__(self, patxmls):
         self._items = {}
-        for xml in fast_iter(patxml):
+        for xml in patxmls:
             self._xml_to_pat(xml)
         self._count = len(self._items.keys())
 
@@ -801,79 +2661,84 @@ class Patterns(object):
         self._items = value
 
 
-# Copied from rpmUtils.miscutils
-# TODO This looks overly complicated, I'm sure we can do better...
+def _range_table():
+    """Whether a provide satisfies a requirement, by comparison result
+
+    Maps (result of the comparison of the provided EVR to the required
+    one, requirement flag, provide flag) to 1 when the ranges overlap, 0
+    otherwise. Same rules as rpmdsCompare, and the same results as the
+    rangeCompare copied from rpmUtils.miscutils. Unknown provide flags are
+    looked up as 0, unknown requirement flags never match.
+    """
+    table = {}
+    for reqf in FLAG_SYMBOLS:
+        for f in FLAG_SYMBOLS.keys() + [0]:
+            table[1, reqf, f] = int(bool(reqf & GT or f & LT))
+            table[0, reqf, f] = int(bool(reqf & f))
+            table[-1, reqf, f] = int(bool(reqf & LT or f & GT))
+    return table
+
+
+_RANGE_TABLE = _range_table()
+
+
 def rangeCompare(reqtuple, provtuple):
     """returns true if provtuple satisfies reqtuple"""
-    (reqn, reqf, (reqe, reqv, reqr)) = reqtuple
-    (n, f, (e, v, r)) = provtuple
-    if reqn != n:
-        return 0
-
-    # unversioned satisfies everything
-    if not f or not reqf:
-        return 1
-
-    # and you thought we were done having fun
-    # if the requested release is left out then we have
-    # to remove release from the package prco to make sure the match
-    # is a success - ie: if the request is EQ foo 1:3.0.0 and we have
-    # foo 1:3.0.0-15 then we have to drop the 15 so we can match
-    if reqr is None:
-        r = None
-    if reqe is None:
-        e = None
-    # just for the record if ver is None then we're going to segfault
-    if reqv is None:
-        v = None
+    return 1 if rangeCompareAll(reqtuple, (provtuple,)) else 0
+
 
+def rangeCompareAll(reqtuple, provtuples):
+    """Return the provtuples that satisfy reqtuple
+
+    The requirement is unpacked and its flag normalized only once, so this
+    is the way to match one requirement against many provides.
+    """
+    (reqn, reqf, (reqe, reqv, reqr)) = reqtuple
+    reqf = FLAGS.get(reqf, reqf)
+    # if the requested release is left out then we have to remove release
+    # from the package prco to make sure the match is a success - ie: if
+    # the request is EQ foo 1:3.0.0 and we have foo 1:3.0.0-15 then we
+    # have to drop the 15 so we can match. Same for epoch and version.
+    reqevr = EVR(reqe, reqv, reqr)
     # if we just require foo-version, then foo-version-* will match
-    if r is None:
-        reqr = None
-
-    rc = evrcmp(EVR(e, v, r), EVR(reqe, reqv, reqr))
-
-    # does not match unless
-    if rc >= 1:
-        if reqf in ['GT', 'GE', 4, 12, '>', '>=']:
-            return 1
-        if reqf in ['EQ', 8, '=']:
-            if f in ['LE', 10, 'LT', 2, '<=', '<']:
-                return 1
-        if reqf in ['LE', 'LT', 'EQ', 10, 2, 8, '<=', '<', '=']:
-            if f in ['LE', 'LT', 10, 2, '<=', '<']:
-                return 1
-
-    if rc == 0:
-        if reqf in ['GT', 4, '>']:
-            if f in ['GT', 'GE', 4, 12, '>', '>=']:
-                return 1
-        if reqf in ['GE', 12, '>=']:
-            if f in ['GT', 'GE', 'EQ', 'LE', 4, 12, 8, 10, '>', '>=', '=', '<=']:
-                return 1
-        if reqf in ['EQ', 8, '=']:
-            if f in ['EQ', 'GE', 'LE', 8, 12, 10, '=', '>=', '<=']:
-                return 1
-        if reqf in ['LE', 10, '<=']:
-            if f in ['EQ', 'LE', 'LT', 'GE', 8, 10, 2, 12, '=', '<=', '<', '>=']:
-                return 1
-        if reqf in ['LT', 2, '<']:
-            if f in ['LE', 'LT', 10, 2, '<=', '<']:
-                return 1
-    if rc <= -1:
-        if reqf in ['GT', 'GE', 'EQ', 4, 12, 8, '>', '>=', '=']:
-            if f in ['GT', 'GE', 4, 12, '>', '>=']:
-                return 1
-        if reqf in ['LE', 'LT', 10, 2, '<=', '<']:
-            return 1
-#                if rc >= 1:
-#                    if reqf in ['GT', 'GE', 4, 12, '>', '>=']:
-#                        return 1
-#                if rc == 0:
-#                    if reqf in ['GE', 'LE', 'EQ', 8, 10, 12, '>=', '<=', '=']:
-#                        return 1
-#                if rc <= -1:
-#                    if reqf in ['LT', 'LE', 2, 10, '<', '<=']:
-#                        return 1
-
-    return 0
+    reqevr_norel = EVR(reqe, reqv, None)
+    result = []
+    for prov in provtuples:
+        (n, f, (e, v, r)) = prov
+        if reqn != n:
+            continue
+
+        # unversioned satisfies everything
+        if not f or not reqf:
+            result.append(prov)
+            continue
+
+        if reqr is None:
+            r = None
+        if reqe is None:
+            e = None
+        if reqv is None:
+            v = None
+
+        rc = evrcmp(EVR(e, v, r), reqevr if r is not None else reqevr_norel)
+        if _RANGE_TABLE.get(
+                ((rc > 0) - (rc < 0), reqf, FLAGS.get(f, 0)), 0):
+            result.append(prov)
+    return result
+
+
+def _range_results():
+    """Comparison results for which rangeCompare matches, by flags
+
+    Maps (requirement flag, provide flag) to the set of results of the
+    comparison of the provided EVR to the required one that match.
+    """
+    results = {}
+    for (rc, reqf, f), matches in _RANGE_TABLE.iteritems():
+        results.setdefault((reqf, f), set())
+        if matches:
+            results[reqf, f].add(rc)
+    return results
+
+
+_RANGE_RESULTS = _range_results()
@@ -3,10 +3,25 @@ import re
 from collections import namedtuple
 from itertools import izip_longest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _EMPTY = (None, '')
 _NOT_SEGMET = re.compile('^[^A-Za-z0-9~^]+')
 _SEGMENT = re.compile(r'^(~|[\^]|[0-9]+|[A-Za-z]+)')
 
+# Keys of the segments of a version, see version_key()
+_EMPTY_KEY = ((-1,),)
+_TILDE_KEY = (0,)
+_END_KEY = (1,)
+_ALPHA = 2
+_DIGIT = 3
+# Memoized version keys, cleared when this many are held
+VERSION_KEYS_MAX = 100000
+_version_keys = {}
+
 
 def rpmvercmp(a, b):
     """Compare rpm version or release strings
@@ -255,6 +270,14 @@ def rpmvercmp(a, b):
     >>> rpmvercmp('1.1.ββ', '1.1.αα')
     0
     """
+    return cmp(version_key(a), version_key(b))
+
+
+def _rpmvercmp_segments(a, b):
+    """rpmvercmp comparing the segments of the strings one by one
+
+    Kept as the reference version_key() is checked against.
+    """
     if a in _EMPTY:
         if b not in _EMPTY:
             return -1
@@ -311,6 +334,70 @@ def _segments(label):
             label = label[sm.end():]
 
 
+def version_key(label):
+    """Sort key of an rpm version or release string
+
+    Keys of different strings compare like rpmvercmp() compares the
+    strings, including the sorting of "~" before and "^" after the end
+    of a version. The keys are memoized per string.
+
+    >>> version_key('1.0~rc1')
+    ((3, 1), (3, 0), (0,), (2, 'rc'), (3, 1), (1,))
+    >>> sorted(['1.0', '1.0^git1', '1.0.1', '', '1.0~rc1', '1.0a'],
+    ...        key=version_key)
+    ['', '1.0~rc1', '1.0', '1.0^git1', '1.0a', '1.0.1']
+
+    The ordering is the same as comparing the segments one by one, for
+    all the test cases of rpmvercmp():
+
+    >>> cases = re.findall(r"rpmvercmp\('(.*)', '(.*)'\)", rpmvercmp.__doc__)
+    >>> len(cases)
+    103
+    >>> [(a, b) for a, b in cases
+    ...  if cmp(version_key(a), version_key(b)) != _rpmvercmp_segments(a, b)]
+    []
+    """
+    try:
+        return _version_keys[label]
+    except KeyError:
+        pass
+    if label in _EMPTY:
+        key = _EMPTY_KEY
+    else:
+        key = []
+        for seg in _segments(label):
+            if seg == '~':
+                key.append(_TILDE_KEY)
+            elif seg.isdigit():
+                key.append((_DIGIT, int(seg)))
+            else:
+                key.append((_ALPHA, seg))
+        key.append(_END_KEY)
+        key = tuple(key)
+    if len(_version_keys) >= VERSION_KEYS_MAX:
+        _version_keys.clear()
+    _version_keys[label] = key
+    return key
+
+
+def evr_key(evr, ignore_release=False):
+    """Sort key of an EVR, ordered like evrcmp()
+
+    Takes the same arguments as evrcmp().
+
+    >>> sorted(['1:1', '2-1', '1-1', '1-1~rc'], key=evr_key)
+    ['1-1~rc', '1-1', '2-1', '1:1']
+    """
+    if not isinstance(evr, EVR):
+        if isinstance(evr, basestring):
+            evr = EVR.from_string(evr)
+        else:
+            evr = EVR(*evr)
+    if ignore_release:
+        return (evr.epoch, version_key(evr.ver))
+    return (evr.epoch, version_key(evr.ver), version_key(evr.rel))
+
+
 def evrcmp(a, b, ignore_release=False):
     """Compare EVRs
 
@@ -346,26 +433,7 @@ def evrcmp(a, b, ignore_release=False):
     >>> evrcmp('1-1-1', '1-1-2')
     -1
     """
-    if not isinstance(a, EVR):
-        if isinstance(a, basestring):
-            a = EVR.from_string(a)
-        else:
-            a = EVR(*a)
-    if not isinstance(b, EVR):
-        if isinstance(b, basestring):
-            b = EVR.from_string(b)
-        else:
-            b = EVR(*b)
-
-    epoch_result = cmp(a.epoch, b.epoch)
-    if epoch_result:
-        return epoch_result
-
-    ver_result = rpmvercmp(a.ver, b.ver)
-    if ignore_release or ver_result:
-        return ver_result
-
-    return rpmvercmp(a.rel, b.rel)
+    return cmp(evr_key(a, ignore_release), evr_key(b, ignore_release))
 
 
 class EVR(namedtuple('EVR', ['epoch', 'ver', 'rel'])):
@@ -544,3 +612,123 @@ def split_rpm_filename(filename):
         epoch = ''
 
     return name, ver, rel, epoch, arch
+
+
+def rank_evrs(evrs):
+    """Rank EVRs with integers that compare like the EVRs
+
+    Every distinct EVR is sorted only once. Returns the list of ranks and
+    the list of EVRs by rank, EVRs that compare equal share their rank.
+
+    >>> rank_evrs(['2-1', '1-1', '1:0', '2-1', '1.01-1', '1.1-1'])
+    ([2, 0, 3, 2, 1, 1], ['1-1', '1.01-1', '2-1', '1:0'])
+    """
+    first = {}
+    keys = []
+    for evr in evrs:
+        key = evr_key(evr)
+        first.setdefault(key, evr)
+        keys.append(key)
+    ordered = sorted(first)
+    rank = dict((key, i) for i, key in enumerate(ordered))
+    return [rank[k] for k in keys], [first[k] for k in ordered]
+
+
+class VersionMatrix(object):
+    """Versions of packages across releases, as a NumPy matrix of ranks
+
+    Takes one iterable of (name, EVR) per release. ranks[i, j] is the rank
+    of the newest version of names[i] in release j, or MISSING. Ranks come
+    from rank_evrs(), so they compare like the EVRs and all the queries
+    are array operations instead of EVR comparisons.
+
+    >>> matrix = VersionMatrix([
+    ...     [("foo", "1.0-1"), ("bar", "2.0-1")],
+    ...     [("foo", "1.1-1"), ("bar", "2.0-1"), ("baz", "1-1")],
+    ...     [("foo", "1.0-2"), ("baz", "0.9-1"), ("baz", "1-1")],
+    ... ])
+    >>> matrix.names
+    ['bar', 'baz', 'foo']
+    >>> matrix.ranks.tolist()
+    [[5, 5, -1], [-1, 1, 1], [2, 4, 3]]
+    >>> matrix.versions("foo")
+    ['1.0-1', '1.1-1', '1.0-2']
+    >>> sorted(matrix.newest().items())
+    [('bar', '2.0-1'), ('baz', '1-1'), ('foo', '1.1-1')]
+    >>> sorted(matrix.changes(1, 2).items())
+    [('bar', 'removed'), ('foo', 'downgraded')]
+    """
+    MISSING = -1
+    # codes of compare()
+    UNCHANGED, ADDED, REMOVED, UPGRADED, DOWNGRADED = range(5)
+    CHANGES = ["unchanged", "added", "removed", "upgraded", "downgraded"]
+
+    def __init__(self, columns):
+        if numpy is None:
+            raise ImportError("VersionMatrix requires numpy")
+        cells = []
+        evrs = []
+        ncolumns = 0
+        for column, packages in enumerate(columns):
+            ncolumns += 1
+            for name, evr in packages:
+                cells.append((name, column))
+                evrs.append(evr)
+        ranks, self.evrs = rank_evrs(evrs)
+
+        self.names = sorted(set(name for name, _ in cells))
+        self._rows = dict((name, i) for i, name in enumerate(self.names))
+        rows = numpy.array(
+            [self._rows[name] for name, _ in cells], dtype=numpy.intp)
+        cols = numpy.array([col for _, col in cells], dtype=numpy.intp)
+        self.ranks = numpy.full(
+            (len(self.names), ncolumns), self.MISSING, dtype=numpy.int32)
+        # keep the newest of several versions of a name in a release
+        numpy.maximum.at(
+            self.ranks, (rows, cols), numpy.array(ranks, dtype=numpy.int32))
+
+    @classmethod
+    def from_sacks(cls, sacks):
+        """VersionMatrix of the packages of RepoSacks, one per release"""
+        return cls(
+            ((po.name, po.version) for po in sack.returnPackages())
+            for sack in sacks
+        )
+
+    def versions(self, name):
+        """EVR of name in each release, None where it is missing"""
+        return [
+            self.evrs[rank] if rank != self.MISSING else None
+            for rank in self.ranks[self._rows[name]]
+        ]
+
+    def newest(self):
+        """Newest EVR of each name across all the releases"""
+        return dict(
+            (name, self.evrs[rank])
+            for name, rank in zip(self.names, self.ranks.max(axis=1))
+        )
+
+    def compare(self, old, new):
+        """Array of the change of each name from release old to new"""
+        old = self.ranks[:, old]
+        new = self.ranks[:, new]
+        return numpy.select(
+            [
+                (old == self.MISSING) & (new != self.MISSING),
+                (old != self.MISSING) & (new == self.MISSING),
+                new > old,
+                new < old,
+            ],
+            [self.ADDED, self.REMOVED, self.UPGRADED, self.DOWNGRADED],
+            default=self.UNCHANGED,
+        )
+
+    def changes(self, old, new):
+        """{name: change} of the names that changed from release old to new
+        """
+        codes = self.compare(old, new)
+        return dict(
+            (self.names[i], self.CHANGES[codes[i]])
+            for i in numpy.flatnonzero(codes != self.UNCHANGED)
+        )
@@ -0,0 +1,359 @@
+"""SQLite store of the primary, filelists and other metadata of a repo
+
+The databases use the createrepo schema, one file per metadata type as
+createrepo publishes them, so a store can be opened on the files built
+from the XML metadata as well as on the ones a repo publishes. Queries go
+through the indexes, nothing beyond the rows asked for is loaded.
+
+>>> import shutil, tempfile
+>>> tmpdir = tempfile.mkdtemp()
+>>> primary = os.path.join(tmpdir, "primary.sqlite")
+>>> build_primary(primary, [{
+...     "pkgid": "a1", "name": "foo", "arch": "noarch", "epoch": "0",
+...     "version": "1.0", "release": "1", "location": "foo.rpm",
+...     "requires": [("bar", "GE", "0", "2", None)],
+...     "provides": [("foo", "EQ", "0", "1.0", "1")],
+... }, {
+...     "pkgid": "b2", "name": "bar", "arch": "x86_64", "epoch": "0",
+...     "version": "2.1", "release": "3", "location": "bar.rpm",
+...     "provides": [("bar", "EQ", "0", "2.1", "3"), ("libbar.so", None,
+...                                                   None, None, None)],
+... }], "sha256:abc")
+>>> filelists = os.path.join(tmpdir, "filelists.sqlite")
+>>> build_filelists(filelists, [
+...     ("a1", (("/usr/bin/foo", "/usr/share/foo/README"),
+...             ("/usr/share/foo",), ())),
+...     ("b2", (("/usr/bin/bar",), (), ("/var/log/bar.log",))),
+... ], "sha256:def")
+>>> other = os.path.join(tmpdir, "other.sqlite")
+>>> build_other(other, [("a1", [("Dev <d@e.com> - 1.0-1", 100, "- foo")])],
+...             "sha256:123")
+>>> db = MetadataDB(primary, filelists, other)
+>>> [row[1:5] for row in db.packages()]
+[('a1', 'foo', 'noarch', '0'), ('b2', 'bar', 'x86_64', '0')]
+>>> db.prco(1)["requires"]
+[('bar', 'GE', '0', '2', None)]
+>>> db.search_prco("provides", "bar")
+[('b2', 'bar', 'EQ', '0', '2.1', '3')]
+>>> db.files("b2")
+(('/usr/bin/bar',), (), ('/var/log/bar.log',))
+>>> db.lookup("/usr/bin/foo"), db.lookup("/usr/bin"), db.lookup("foo")
+(['a1'], [], [])
+>>> db.prefix("/usr/share/foo")
+[('/usr/share/foo/README', 'a1')]
+>>> db.prefix("/usr/bin/")
+[('/usr/bin/bar', 'b2'), ('/usr/bin/foo', 'a1')]
+>>> db.changelog("a1")
+[('Dev <d@e.com> - 1.0-1', 100, '- foo')]
+>>> db.close()
+>>> shutil.rmtree(tmpdir)
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+DBVERSION = 10
+
+PRCO_KINDS = ("requires", "provides", "obsoletes", "conflicts")
+
+PRIMARY_SCHEMA = """
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages (
+    pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT,
+    version TEXT, epoch TEXT, release TEXT, summary TEXT, description TEXT,
+    url TEXT, time_file INTEGER, time_build INTEGER, rpm_license TEXT,
+    rpm_vendor TEXT, rpm_group TEXT, rpm_buildhost TEXT,
+    rpm_sourcerpm TEXT, rpm_header_start INTEGER, rpm_header_end INTEGER,
+    rpm_packager TEXT, size_package INTEGER, size_installed INTEGER,
+    size_archive INTEGER, location_href TEXT, location_base TEXT,
+    checksum_type TEXT);
+CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER);
+CREATE TABLE requires (
+    name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+    pkgKey INTEGER, pre BOOLEAN DEFAULT FALSE);
+CREATE TABLE provides (
+    name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+    pkgKey INTEGER);
+CREATE TABLE obsoletes (
+    name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+    pkgKey INTEGER);
+CREATE TABLE conflicts (
+    name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+    pkgKey INTEGER);
+"""
+
+PRIMARY_INDEXES = """
+CREATE INDEX packagename ON packages (name);
+CREATE INDEX packageId ON packages (pkgId);
+CREATE INDEX filenames ON files (name);
+CREATE INDEX pkgfiles ON files (pkgKey);
+CREATE INDEX pkgrequires ON requires (pkgKey);
+CREATE INDEX requiresname ON requires (name);
+CREATE INDEX pkgprovides ON provides (pkgKey);
+CREATE INDEX providesname ON provides (name);
+CREATE INDEX pkgobsoletes ON obsoletes (pkgKey);
+CREATE INDEX obsoletesname ON obsoletes (name);
+CREATE INDEX pkgconflicts ON conflicts (pkgKey);
+CREATE INDEX conflictsname ON conflicts (name);
+"""
+
+FILELISTS_SCHEMA = """
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+CREATE TABLE filelist (
+    pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT);
+"""
+
+FILELISTS_INDEXES = """
+CREATE INDEX keyfile ON filelist (pkgKey);
+CREATE INDEX pkgId ON packages (pkgId);
+CREATE INDEX dirnames ON filelist (dirname);
+"""
+
+OTHER_SCHEMA = """
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+CREATE TABLE changelog (
+    pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT);
+"""
+
+OTHER_INDEXES = """
+CREATE INDEX keychange ON changelog (pkgKey);
+CREATE INDEX pkgId ON packages (pkgId);
+"""
+
+# the columns of packages loaded for a Package
+PACKAGE_COLUMNS = (
+    "pkgKey", "pkgId", "name", "arch", "epoch", "version", "release",
+    "summary", "description", "url", "rpm_packager", "rpm_sourcerpm",
+    "rpm_license", "rpm_vendor", "rpm_group", "location_href",
+)
+
+# filetypes of the filelist table, in the order of Repo.filelists entries
+FILE_TYPES = "fdg"
+
+
+def _text(data):
+    """text_factory returning str for ASCII and unicode otherwise, as lxml
+    """
+    try:
+        data.decode("ascii")
+        return data
+    except UnicodeDecodeError:
+        return data.decode("utf-8", "replace")
+
+
+def _build(filename, schema, indexes, checksum, fill):
+    """Write a database to filename by calling fill with its connection
+
+    The database is built in a temporary file renamed to filename, indexes
+    are only created once the tables are filled.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmpname)
+        try:
+            conn.text_factory = _text
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.executescript(schema)
+            conn.execute(
+                "INSERT INTO db_info VALUES (?, ?)", (DBVERSION, checksum))
+            fill(conn)
+            conn.executescript(indexes)
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmpname, filename)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+
+
+def build_primary(filename, packages, checksum):
+    """Write the primary database of an iterable of package dicts
+
+    Each dict has the pkgid, name, arch, epoch, version, release, summary,
+    description, url, packager, sourcerpm, license, vendor, group and
+    location of a package, and lists of (name, flags, epoch, version,
+    release) for requires, provides, obsoletes and conflicts.
+    """
+    def fill(conn):
+        for pkgkey, pkg in enumerate(packages, 1):
+            get = pkg.get
+            conn.execute(
+                "INSERT INTO packages (pkgKey, pkgId, name, arch, epoch, "
+                "version, release, summary, description, url, "
+                "rpm_packager, rpm_sourcerpm, rpm_license, rpm_vendor, "
+                "rpm_group, location_href) VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (pkgkey, get("pkgid"), get("name"), get("arch"),
+                 get("epoch"), get("version"), get("release"),
+                 get("summary"), get("description"), get("url"),
+                 get("packager"), get("sourcerpm"), get("license"),
+                 get("vendor"), get("group"), get("location")),
+            )
+            for kind in PRCO_KINDS:
+                conn.executemany(
+                    "INSERT INTO %s (name, flags, epoch, version, release, "
+                    "pkgKey) VALUES (?, ?, ?, ?, ?, ?)" % kind,
+                    (entry + (pkgkey,) for entry in get(kind, ())),
+                )
+    _build(filename, PRIMARY_SCHEMA, PRIMARY_INDEXES, checksum, fill)
+
+
+def build_filelists(filename, filelists, checksum):
+    """Write the filelists database of an iterable of
+    (pkgid, (files, dirs, ghosts))
+    """
+    def fill(conn):
+        for pkgkey, (pkgid, entries) in enumerate(filelists, 1):
+            conn.execute(
+                "INSERT INTO packages VALUES (?, ?)", (pkgkey, pkgid))
+            dirs = {}
+            for filetype, paths in zip(FILE_TYPES, entries):
+                for path in paths:
+                    dirname, basename = path.rsplit("/", 1)
+                    dirs.setdefault(dirname or "/", []).append(
+                        (basename, filetype))
+            conn.executemany(
+                "INSERT INTO filelist VALUES (?, ?, ?, ?)",
+                ((pkgkey, dirname,
+                  "/".join(name for name, _ in names),
+                  "".join(filetype for _, filetype in names))
+                 for dirname, names in sorted(dirs.iteritems())),
+            )
+    _build(filename, FILELISTS_SCHEMA, FILELISTS_INDEXES, checksum, fill)
+
+
+def build_other(filename, changelogs, checksum):
+    """Write the other database of an iterable of
+    (pkgid, [(author, date, text)])
+    """
+    def fill(conn):
+        for pkgkey, (pkgid, entries) in enumerate(changelogs, 1):
+            conn.execute(
+                "INSERT INTO packages VALUES (?, ?)", (pkgkey, pkgid))
+            conn.executemany(
+                "INSERT INTO changelog VALUES (?, ?, ?, ?)",
+                ((pkgkey, author, date, text)
+                 for author, date, text in entries),
+            )
+    _build(filename, OTHER_SCHEMA, OTHER_INDEXES, checksum, fill)
+
+
+def _join(dirname, name):
+    if dirname == "/":
+        return "/" + name
+    return dirname + "/" + name
+
+
+class MetadataDB(object):
+    """Read only queries on the primary, filelists and other databases
+
+    filelists and other are attached to the primary database connection,
+    the connection is shared by the threads of the process.
+    """
+
+    def __init__(self, primary, filelists=None, other=None):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(primary, check_same_thread=False)
+        self._conn.text_factory = _text
+        self._conn.execute("PRAGMA query_only = ON")
+        self.has_filelists = filelists is not None
+        self.has_other = other is not None
+        if filelists is not None:
+            self._conn.execute("ATTACH DATABASE ? AS filelists", (filelists,))
+        if other is not None:
+            self._conn.execute("ATTACH DATABASE ? AS other", (other,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def packages(self):
+        """Rows of PACKAGE_COLUMNS of the binary packages, by pkgKey"""
+        return self._query(
+            "SELECT %s FROM packages WHERE arch != 'src' ORDER BY pkgKey" %
+            ", ".join(PACKAGE_COLUMNS))
+
+    def prco(self, pkgkey):
+        """{kind: [(name, flags, epoch, version, release)]} of a package"""
+        return dict(
+            (kind, self._query(
+                "SELECT name, flags, epoch, version, release FROM %s "
+                "WHERE pkgKey = ? ORDER BY rowid" % kind, pkgkey))
+            for kind in PRCO_KINDS
+        )
+
+    def search_prco(self, kind, name):
+        """(pkgid, name, flags, epoch, version, release) of the named
+        entries of a kind
+        """
+        return self._query(
+            "SELECT p.pkgId, c.name, c.flags, c.epoch, c.version, c.release "
+            "FROM %s c JOIN packages p USING (pkgKey) "
+            "WHERE c.name = ? ORDER BY c.rowid" % kind, name)
+
+    def files(self, pkgid):
+        """(files, dirs, ghosts) of a package"""
+        entries = dict((filetype, []) for filetype in FILE_TYPES)
+        if self.has_filelists:
+            for dirname, names, filetypes in self._query(
+                    "SELECT f.dirname, f.filenames, f.filetypes "
+                    "FROM filelists.filelist f "
+                    "JOIN filelists.packages p USING (pkgKey) "
+                    "WHERE p.pkgId = ?", pkgid):
+                for name, filetype in zip(names.split("/"), filetypes):
+                    entries.get(filetype, entries["f"]).append(
+                        _join(dirname, name))
+        return tuple(tuple(entries[filetype]) for filetype in FILE_TYPES)
+
+    def _dirs(self, where, *args):
+        if not self.has_filelists:
+            return []
+        return self._query(
+            "SELECT p.pkgId, f.dirname, f.filenames "
+            "FROM filelists.filelist f "
+            "JOIN filelists.packages p USING (pkgKey) WHERE " + where, *args)
+
+    def lookup(self, path):
+        """Return the pkgids of the packages owning path"""
+        if "/" not in path:
+            # as PathIndex, only absolute paths are owned
+            return []
+        dirname, basename = path.rsplit("/", 1)
+        return [
+            pkgid for pkgid, _, names in self._dirs(
+                "f.dirname = ?", dirname or "/")
+            if basename in names.split("/")
+        ]
+
+    def prefix(self, directory):
+        """Return (path, pkgid) of all paths below directory, sorted"""
+        directory = directory.rstrip("/")
+        # "0" follows "/", the range has all the dirnames below directory
+        rows = self._dirs(
+            "f.dirname = ? OR (f.dirname >= ? AND f.dirname < ?)",
+            directory or "/", directory + "/", directory + "0")
+        return sorted(
+            (_join(dirname, name), pkgid)
+            for pkgid, dirname, names in rows
+            for name in names.split("/")
+        )
+
+    def changelog(self, pkgid):
+        """[(author, date, text)] of a package"""
+        if not self.has_other:
+            return []
+        return self._query(
+            "SELECT c.author, c.date, c.changelog FROM other.changelog c "
+            "JOIN other.packages p USING (pkgKey) "
+            "WHERE p.pkgId = ? ORDER BY c.rowid", pkgid)
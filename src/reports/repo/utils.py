@@ -24,6 +24,7 @@ from .misc import (
 )
 from .models import Arch, Graph, Image, PackageMetaType, Repo
 from .rpmmd import RepoSack
+from .rpmutils import evr_key
 
 try:
     from lxml import etree
@@ -753,7 +754,7 @@ def _diff_sacks(newrepo, oldrepo, progress_cb):
             nvr = "%s - %s-%s" % (pkg.name, pkg.ver, pkg.rel)
 
             oldpkgs = list(old_comparable.searchNames(pkg.name))
-            oldpkgs.sort(cmp=lambda x, y: x.verCMP(y), reverse=True)
+            oldpkgs.sort(key=lambda po: evr_key(po.version), reverse=True)
             oldpkgs = oldpkgs[:1]
 
             for oldpkg in oldpkgs:
@@ -0,0 +1,96 @@
+"""Byte offsets of the elements of a metadata file
+
+The metadata files are a root element holding a long list of elements of
+the same tag. The offsets of those elements are found by a plain search of
+the memory mapped file, so that a single element can be parsed again later
+without going through the file.
+
+>>> import tempfile
+>>> fd, filename = tempfile.mkstemp()
+>>> with os.fdopen(fd, "w") as xml:
+...     xml.write('<?xml version="1.0"?>\\n'
+...               '<metadata xmlns="http://example.com/md" packages="2">\\n'
+...               '<package type="rpm"><name>foo</name>'
+...               '<packager>me</packager></package>\\n'
+...               '<package type="rpm"><name>bar</name></package>\\n'
+...               '</metadata>\\n')
+>>> offsets = ElementOffsets(filename, "package")
+>>> len(offsets)
+2
+>>> elem = offsets.element(1)
+>>> elem.tag, elem.findtext("{http://example.com/md}name")
+('{http://example.com/md}package', 'bar')
+>>> offsets.index("<name>foo<"), offsets.index("<name>baz<")
+(0, None)
+>>> offsets.close()
+>>> os.unlink(filename)
+"""
+import array
+import bisect
+import mmap
+import os
+
+from lxml import etree
+
+
+class ElementOffsets(object):
+
+    def __init__(self, filename, tag):
+        self.filename = filename
+        self._offsets = array.array("L")
+        self._mmap = None
+        self._head = self._tail = ""
+        self._end = 0
+        if not os.path.getsize(filename):
+            return
+        with open(filename, "rb") as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._mmap
+        start = "<%s" % tag
+        pos = data.find(start)
+        while pos >= 0:
+            # skip the tags that only start with the same name
+            if data[pos + len(start):pos + len(start) + 1] in (
+                    " ", "\t", "\r", "\n", ">"):
+                self._offsets.append(pos)
+            pos = data.find(start, pos + len(start))
+        if not self._offsets:
+            return
+        self._head = data[:self._offsets[0]]
+        self._end = data.rfind("</")
+        self._tail = data[self._end:]
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def index(self, text):
+        """Index of the first element holding text, None if there is none"""
+        if not self._offsets:
+            return None
+        pos = self._mmap.find(text, self._offsets[0], self._end)
+        if pos < 0:
+            return None
+        return bisect.bisect_right(self._offsets, pos) - 1
+
+    def element(self, index):
+        """Parse the element at index
+
+        It is parsed within the root element, for its namespaces.
+        """
+        start = self._offsets[index]
+        if index + 1 < len(self._offsets):
+            end = self._offsets[index + 1]
+        else:
+            end = self._end
+        root = etree.fromstring(
+            self._head + self._mmap[start:end] + self._tail,
+            etree.XMLParser(recover=True))
+        if root is None or not len(root):
+            raise ValueError(
+                "No element at offset %d of %s" % (start, self.filename))
+        return root[0]
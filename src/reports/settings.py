@@ -43,6 +43,37 @@ if not isdir(YUM_CACHE_DIR):
 
 SSL_VERIFY = config.getboolean('base', 'ssl_verify')
 
+# Memory budget in bytes for parsed yum repos kept in each worker process
+YUM_REGISTRY_SIZE = config.getint('base', 'yum_registry_size') * 1024 * 1024
+
+# Seconds a fetched repomd.xml is trusted before revalidating it
+YUM_LIVE_TTL = config.getint('base', 'yum_live_ttl')
+YUM_RELEASED_TTL = config.getint('base', 'yum_released_ttl')
+
+# Number of threads fetching the repos of a container in parallel
+YUM_FETCH_WORKERS = config.getint('base', 'yum_fetch_workers')
+
+# HTTP settings for fetching repo metadata
+YUM_CONNECT_TIMEOUT = config.getfloat('base', 'yum_connect_timeout')
+YUM_READ_TIMEOUT = config.getfloat('base', 'yum_read_timeout')
+YUM_RETRIES = config.getint('base', 'yum_retries')
+YUM_POOL_SIZE = config.getint('base', 'yum_pool_size')
+
+# Failures after which a repo server is not contacted for cooldown seconds
+YUM_BREAKER_FAILURES = config.getint('base', 'yum_breaker_failures')
+YUM_BREAKER_COOLDOWN = config.getint('base', 'yum_breaker_cooldown')
+
+# Package storage engine
+YUM_STORE = config.get('base', 'yum_store')
+if YUM_STORE not in ('memory', 'sqlite', 'mmap'):
+    raise ImproperlyConfigured(
+        "yum_store must be 'memory', 'sqlite' or 'mmap', not '%s'" % YUM_STORE
+    )
+# Query the SQLite databases published by repositories
+YUM_UPSTREAM_DB = config.getboolean('base', 'yum_upstream_db')
+# Parse the capabilities of primary.xml packages on first use
+YUM_HEADER_ONLY = config.getboolean('base', 'yum_header_only')
+
 _db_options = json.loads(config.get('db', 'options'))
 DATABASES = {
     'default': {